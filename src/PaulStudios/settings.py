@@ -208,6 +208,38 @@ GCS_API_KEY = env("GCS_API_KEY")
 GCS_ENGINE_ID = env("GCS_ENGINE_ID")
 YT_API_KEY = env("YT_API_KEY")
 
+# Seconds to keep Spotify playlist and track documents in Redis (0 disables).
+SONGDOWNLOADER_SPOTIFY_METADATA_TTL = env.int("SONGDOWNLOADER_SPOTIFY_METADATA_TTL", default=60)
+
+# How long a Spotify track -> YouTube video lookup is reused, and how long
+# a lookup that found nothing is remembered before YouTube is searched again.
+SONGDOWNLOADER_RESOLUTION_TTL_DAYS = env.int("SONGDOWNLOADER_RESOLUTION_TTL_DAYS", default=30)
+SONGDOWNLOADER_RESOLUTION_MISS_TTL_HOURS = env.int("SONGDOWNLOADER_RESOLUTION_MISS_TTL_HOURS", default=6)
+
+SONGDOWNLOADER_AUDIO_CACHE_DIR = env("SONGDOWNLOADER_AUDIO_CACHE_DIR",
+                                     default=os.path.join(BASE_DIR, "songdownloader", f"media_{MODE}", "_audio_cache"))
+SONGDOWNLOADER_AUDIO_CACHE_MAX_MB = env.int("SONGDOWNLOADER_AUDIO_CACHE_MAX_MB", default=5 * 1024)
+
+# Longest side in pixels and format (WEBP or JPEG) of the cover art kept for
+# songs and playlists.
+SONGDOWNLOADER_IMAGE_SIZE = env.int("SONGDOWNLOADER_IMAGE_SIZE", default=300)
+SONGDOWNLOADER_IMAGE_FORMAT = env("SONGDOWNLOADER_IMAGE_FORMAT", default="WEBP")
+
+# Split big playlists into per-chunk Celery subtasks. Needs the media folder
+# on a volume shared by every worker container.
+SONGDOWNLOADER_FANOUT = env.bool("SONGDOWNLOADER_FANOUT", default=False)
+SONGDOWNLOADER_FANOUT_MIN_TRACKS = env.int("SONGDOWNLOADER_FANOUT_MIN_TRACKS", default=100)
+SONGDOWNLOADER_FANOUT_CHUNK_SIZE = env.int("SONGDOWNLOADER_FANOUT_CHUNK_SIZE", default=25)
+
+# YouTube Data API budget shared by every worker: units per day (reset at
+# midnight Pacific time), the level below which jobs skip optional calls,
+# and a token bucket for the request rate.
+SONGDOWNLOADER_YOUTUBE_DAILY_QUOTA = env.int("SONGDOWNLOADER_YOUTUBE_DAILY_QUOTA", default=10000)
+SONGDOWNLOADER_YOUTUBE_QUOTA_LOW = env.int("SONGDOWNLOADER_YOUTUBE_QUOTA_LOW", default=1000)
+SONGDOWNLOADER_YOUTUBE_RATE = env.float("SONGDOWNLOADER_YOUTUBE_RATE", default=10.0)
+SONGDOWNLOADER_YOUTUBE_BURST = env.int("SONGDOWNLOADER_YOUTUBE_BURST", default=20)
+SONGDOWNLOADER_YOUTUBE_MAX_WAIT = env.int("SONGDOWNLOADER_YOUTUBE_MAX_WAIT", default=30)
+
 RECAPTCHA_PUBLIC_KEY = env("RECAPTCHA_SITE_KEY")
 RECAPTCHA_PRIVATE_KEY = env("RECAPTCHA_SECRET_KEY")
 
@@ -1,19 +1,20 @@
 import base64
-import json
 import os
 import shutil
+import threading
 import time
 from pathlib import Path
 
 import redis
 from celery import shared_task
-from celery.signals import worker_ready, task_success
+from celery.signals import task_postrun, task_success, worker_process_shutdown
 from celery.result import AsyncResult
 from django.contrib.auth import get_user_model
 
 from PaulStudios import settings
 from PaulStudios.celery import app
 from songdownloader.models import SpotifySong, SpotifyPlaylist, UserLogRecent, UserHistory
+from songdownloader.services.images import IN_USE_TTL, release_image
 
 redis_db = redis.from_url(settings.REDIS_URL, decode_responses=True)
 User = get_user_model()
@@ -24,20 +25,128 @@ def delete_key(self, key):
     redis_db.delete(key)
 
 
+# Everything the progress page shows for a task lives in one hash, so it
+# can be updated atomically and read back in a single call.
+PROGRESS_TTL = 24 * 60 * 60
+# Per-track updates are collected in memory and written at most this often.
+PROGRESS_FLUSH_INTERVAL = 0.25
+
+_pending = {}
+_pending_lock = threading.Lock()
+# Held from taking the buffered updates until they are written, so a write
+# for a task cannot overtake an increment that is still on its way.
+_flush_lock = threading.RLock()
+_flusher = None
+
+
+# Writes only the fields whose value changed, bumps the counter and
+# publishes the changes as JSON on a channel named after the hash, which is
+# what the progress stream listens to. Publishes nothing when nothing changed.
+UPDATE_SCRIPT = """
+local changed = {}
+local any = false
+for i = 3, #ARGV, 2 do
+    if redis.call('HGET', KEYS[1], ARGV[i]) ~= ARGV[i + 1] then
+        redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 1])
+        changed[ARGV[i]] = ARGV[i + 1]
+        any = true
+    end
+end
+local increment = tonumber(ARGV[1])
+if increment ~= 0 then
+    changed['progress'] = tostring(redis.call('HINCRBY', KEYS[1], 'progress', increment))
+    any = true
+end
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+if any then
+    redis.call('PUBLISH', KEYS[1], cjson.encode(changed))
+end
+return any and 1 or 0
+"""
+_update = redis_db.register_script(UPDATE_SCRIPT)
+
+
+def progress_key(task_id):
+    return f"task-progress-{task_id}"
+
+
+def _buffer_progress(task_id, increment, fields):
+    global _flusher
+    with _pending_lock:
+        entry = _pending.setdefault(task_id, [0, {}])
+        entry[0] += increment
+        entry[1].update(fields)
+        if _flusher is None:
+            _flusher = threading.Thread(target=_flush_loop, name="progress-flusher", daemon=True)
+            _flusher.start()
+
+
+def _flush_loop():
+    global _flusher
+    while True:
+        time.sleep(PROGRESS_FLUSH_INTERVAL)
+        try:
+            flush_progress()
+        except redis.RedisError as e:
+            print(f"Error flushing progress: {e}")
+        with _pending_lock:
+            if not _pending:
+                _flusher = None
+                return
+
+
+def _update_args(increment, fields):
+    args = [increment, PROGRESS_TTL]
+    for name, value in fields.items():
+        args.extend((name, value))
+    return args
+
+
+def flush_progress(task_id=None):
+    """Write buffered progress to Redis, for one task or for every task."""
+    with _flush_lock:
+        with _pending_lock:
+            if task_id is None:
+                items = list(_pending.items())
+                _pending.clear()
+            else:
+                entry = _pending.pop(task_id, None)
+                items = [(task_id, entry)] if entry else []
+        if not items:
+            return
+        pipe = redis_db.pipeline(transaction=False)
+        for task_id, (increment, fields) in items:
+            _update(keys=[progress_key(task_id)], args=_update_args(increment, fields), client=pipe)
+        pipe.execute()
+
+
+def set_progress_fields(task_id, **fields):
+    # Pending increments go first so they cannot land on top of these values.
+    with _flush_lock:
+        flush_progress(task_id)
+        _update(keys=[progress_key(task_id)], args=_update_args(0, fields))
+
+
+def get_progress_fields(task_id):
+    return redis_db.hgetall(progress_key(task_id))
+
+
 def increase_progress(task_id):
-    string = f"progress-{task_id}"
-    redis_db.set(string, int(redis_db.get(string)) + 1)
+    _buffer_progress(task_id, 1, {})
 
 
 def set_progress(progress, task_id):
-    string = f"progress-{task_id}"
-    redis_db.set(string, progress)
+    set_progress_fields(task_id, progress=progress)
 
 
 def update_progress(name, task_id, img="/static/image_loading.svg"):
-    redis_db.set(f"current-{task_id}", name)
-    redis_db.set(f"image-{task_id}", img)
-    increase_progress(task_id)
+    _buffer_progress(task_id, 1, {"current": name, "image": img})
+
+
+@task_postrun.connect
+@worker_process_shutdown.connect
+def flush_all_progress(**kwargs):
+    flush_progress()
 
 
 @shared_task
@@ -61,54 +170,19 @@ def delete_folder(folder):
         raise
 
 
-@worker_ready.connect
-def setup(sender, **kwargs):
-    worker_list_upload.delay()
+# Downloader tasks whose progress page can be shown have a key here. It is
+# set when the task is dispatched and deleted when its files are cleaned
+# up. Tasks that never get that far expire along with their progress data.
+def registry_key(task_id):
+    return f"downloader-task-{task_id}"
 
 
-@app.task(bind=True)
-def worker_list_upload(self):
-    worker_list = [*app.control.inspect().stats().keys()]
-    print(f"Active Workers: {worker_list}")
-    redis_db.set("workers", json.dumps(worker_list))
-    if redis_db.get("task_list") is None:
-        redis_db.set("task_list", json.dumps([""]))
+def register_task(task_id):
+    redis_db.set(registry_key(task_id), 1, ex=PROGRESS_TTL)
 
 
-@app.task(bind=True)
-def update_celery_task_list(self):
-    scheduled_total = []
-    active_total = []
-    reserved_total = []
-    worker_list = json.loads(redis_db.get("workers"))
-    for worker in worker_list:
-        celery_app = app.control.inspect([worker])
-        if celery_app.scheduled():
-            scheduled = celery_app.scheduled().get(worker)
-            for task in scheduled:
-                if "songdownloader.tasks" in task['request']['name']:
-                    scheduled_total.append(task['request']['id'])
-        if celery_app.active():
-            active = celery_app.active().get(worker)
-            for task in active:
-                if "songdownloader.tasks" in task['name']:
-                    active_total.append(task['id'])
-        if celery_app.reserved():
-            reserved = celery_app.reserved().get(worker)
-            for task in reserved:
-                if "songdownloader.tasks" in task['name']:
-                    reserved_total.append(task['id'])
-    total = []
-    total.extend(scheduled_total)
-    total.extend(active_total)
-    total.extend(reserved_total)
-    task_list = json.loads(redis_db.get("task_list"))
-    task_list.extend(total)
-    res = []
-    [res.append(str(x)) for x in task_list if x not in res]
-    redis_db.set("task_list", json.dumps(res))
-    print("Task_List updated")
-    return res
+def is_registered_task(task_id):
+    return bool(redis_db.exists(registry_key(task_id)))
 
 
 @app.task(bind=True)
@@ -122,16 +196,7 @@ def delete_task_data(self, userlog_id):
     BASE_DIR = Path(__file__).resolve().parent.parent
     task.forget()
 
-    redis_db.delete(f"total-{task_id}")
-    redis_db.delete(f"progress-{task_id}")
-    redis_db.delete(f"name-{task_id}")
-    redis_db.delete(f"current-{task_id}")
-    redis_db.delete(f"image-{task_id}")
-    task_list = json.loads(redis_db.get("task_list"))
-    print(task_list)
-    print(task_id, type(task_id))
-    task_list.remove(task_id)
-    redis_db.set("task_list", json.dumps(task_list))
+    redis_db.delete(progress_key(task_id), registry_key(task_id))
 
     delete_local_file.delay(str(BASE_DIR / path))
 
@@ -150,11 +215,13 @@ def delete_task_data(self, userlog_id):
 def remove_db_data(self, userhistory_id):
     data = UserHistory.objects.get(pk=userhistory_id)
     service_id = data.service_id
+    covers = []
     if data.mode.split("-")[-1] == "Playlist":
         playlist = SpotifyPlaylist.objects.get(pk=service_id)
-        list_of_songs = playlist.tracks.all()
-        playlist.image.delete()
+        # Read before the playlist goes, which also removes its track entries.
+        list_of_songs = list(playlist.tracks.all())
         playlist.delete()
+        covers.append(playlist.image.name)
     elif data.mode.split("-")[-1] == "Track":
         try:
             list_of_songs = [SpotifySong.objects.get(pk=service_id)]
@@ -164,5 +231,16 @@ def remove_db_data(self, userhistory_id):
     else:
         list_of_songs = []
     for song in list_of_songs:
-        song.image.delete()
         song.delete()
+        # Songs from the same album share their cover image.
+        covers.append(song.image.name)
+    release_images(covers)
+
+
+@app.task(bind=True)
+def release_images(self, names):
+    # Covers a running job has just picked up are tried again once it had
+    # time to save its rows.
+    pending = [name for name in names if not release_image(name)]
+    if pending:
+        release_images.apply_async((pending,), countdown=IN_USE_TTL)
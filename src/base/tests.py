@@ -1,7 +1,16 @@
+import asyncio
+import json
+import threading
+import time
 from unittest import TestCase
-from unittest.mock import patch
+from unittest.mock import AsyncMock, MagicMock, patch
 
-from .tasks import delete_local_file, delete_folder
+from django.test import AsyncRequestFactory, RequestFactory
+
+from . import tasks as base_tasks
+from .tasks import (IN_USE_TTL, PROGRESS_TTL, delete_local_file, delete_folder, flush_progress, increase_progress,
+                    is_registered_task, register_task, release_images, set_progress, update_progress)
+from .views import progress_events, task_progress, task_progress_stream
 
 
 class BackendTasksTestCase(TestCase):
@@ -17,3 +26,156 @@ class BackendTasksTestCase(TestCase):
         folder = '/path/to/folder'
         delete_folder(folder)
         mock_rmtree.assert_called_once_with(folder)
+
+
+@patch('base.tasks._update')
+@patch('base.tasks.redis_db')
+class ProgressTestCase(TestCase):
+
+    @patch('base.tasks._flusher', MagicMock())
+    def test_updates_are_coalesced_until_flushed(self, mock_redis, mock_update):
+        pipe = mock_redis.pipeline.return_value
+        for _ in range(5):
+            increase_progress("t1")
+        update_progress("Song", "t1", "/media/songs/a.webp")
+        mock_update.assert_not_called()
+
+        flush_progress()
+
+        mock_update.assert_called_once_with(
+            keys=["task-progress-t1"],
+            args=[6, PROGRESS_TTL, "current", "Song", "image", "/media/songs/a.webp"],
+            client=pipe)
+        pipe.execute.assert_called_once()
+
+    @patch('base.tasks._flusher', MagicMock())
+    def test_set_progress_writes_pending_updates_first(self, mock_redis, mock_update):
+        increase_progress("t1")
+        set_progress(0, "t1")
+
+        self.assertEqual([c.kwargs["args"] for c in mock_update.call_args_list],
+                         [[1, PROGRESS_TTL], [0, PROGRESS_TTL, "progress", 0]])
+
+    @patch('base.tasks._flusher', MagicMock())
+    def test_set_progress_waits_for_a_flush_in_flight(self, mock_redis, mock_update):
+        writing, release = threading.Event(), threading.Event()
+
+        def slow_execute():
+            writing.set()
+            release.wait(5)
+
+        mock_redis.pipeline.return_value.execute.side_effect = slow_execute
+        increase_progress("t1")
+        flusher = threading.Thread(target=flush_progress)
+        flusher.start()
+        writing.wait(5)
+        setter = threading.Thread(target=set_progress, args=(10, "t1"))
+        setter.start()
+        setter.join(0.1)
+        self.assertTrue(setter.is_alive())
+
+        release.set()
+        flusher.join()
+        setter.join()
+
+        self.assertEqual([c.kwargs["args"] for c in mock_update.call_args_list],
+                         [[1, PROGRESS_TTL], [0, PROGRESS_TTL, "progress", 10]])
+
+    @patch('base.tasks.PROGRESS_FLUSH_INTERVAL', 0.01)
+    @patch('base.tasks._flusher', None)
+    def test_background_flush(self, mock_redis, mock_update):
+        increase_progress("t1")
+        deadline = time.monotonic() + 2
+        while base_tasks._flusher is not None and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        self.assertIsNone(base_tasks._flusher)
+        mock_update.assert_called_once_with(keys=["task-progress-t1"], args=[1, PROGRESS_TTL],
+                                            client=mock_redis.pipeline.return_value)
+
+    @patch('base.views.AsyncResult')
+    def test_task_progress_reads_the_hash_once(self, mock_result, mock_redis, mock_update):
+        mock_redis.hgetall.return_value = {"progress": "4", "total": "10", "name": "Mix"}
+        mock_result.return_value.state = "PROGRESS"
+        mock_result.return_value.info = None
+
+        response = task_progress(RequestFactory().get("/"), "t1")
+
+        mock_redis.hgetall.assert_called_once_with("task-progress-t1")
+        data = json.loads(response.content)
+        self.assertEqual((data["progress"], data["total"], data["name"], data["image"]), ("4", "10", "Mix", None))
+
+
+@patch('base.tasks.redis_db')
+class TaskRegistryTestCase(TestCase):
+
+    def test_registration_is_a_key_that_expires(self, mock_redis):
+        register_task("t1")
+        mock_redis.set.assert_called_once_with("downloader-task-t1", 1, ex=PROGRESS_TTL)
+
+        mock_redis.exists.return_value = 1
+        self.assertTrue(is_registered_task("t1"))
+        mock_redis.exists.assert_called_once_with("downloader-task-t1")
+
+
+class ReleaseImagesTestCase(TestCase):
+
+    @patch('base.tasks.release_images.apply_async')
+    @patch('base.tasks.release_image', side_effect=lambda name: name != "songs/busy.webp")
+    def test_images_in_use_are_retried_later(self, mock_release, mock_apply):
+        release_images(["songs/free.webp", "songs/busy.webp"])
+
+        mock_apply.assert_called_once_with((["songs/busy.webp"],), countdown=IN_USE_TTL)
+
+
+class ProgressStreamTestCase(TestCase):
+
+    def collect(self, messages, progress, state="PROGRESS"):
+        client = MagicMock()
+        client.hgetall = AsyncMock(return_value=progress)
+        client.aclose = AsyncMock()
+        pubsub = client.pubsub.return_value
+        pubsub.subscribe = AsyncMock()
+        pubsub.get_message = AsyncMock(side_effect=messages)
+        pubsub.aclose = AsyncMock()
+
+        async def run():
+            return [event async for event in progress_events("t1")]
+
+        with patch('base.views.aioredis.from_url', return_value=client), \
+                patch('base.views.task_state', return_value={"state": state, "details": None}):
+            events = asyncio.run(run())
+        pubsub.subscribe.assert_awaited_once_with("task-progress-t1", "celery-task-meta-t1")
+        pubsub.aclose.assert_awaited_once()
+        return events
+
+    def test_snapshot_then_changed_fields_only(self):
+        messages = [
+            {"channel": "task-progress-t1", "data": json.dumps({"progress": "5", "current": "Song"})},
+            None,
+            {"channel": "task-progress-t1", "data": json.dumps({"progress": "6", "current": "Song"})},
+            {"channel": "celery-task-meta-t1",
+             "data": json.dumps({"status": "SUCCESS", "result": {"extra": {"failed_downloads": []}}})},
+        ]
+        events = self.collect(messages, {"progress": "4", "total": "10", "current": "Old"})
+
+        self.assertEqual(events[1:], [
+            'data: {"progress": "5", "current": "Song"}\n\n',
+            ": keep-alive\n\n",
+            'data: {"progress": "6"}\n\n',
+            'data: {"state": "SUCCESS", "details": {"extra": {"failed_downloads": []}}}\n\n',
+        ])
+        snapshot = json.loads(events[0][len("data: "):])
+        self.assertEqual((snapshot["progress"], snapshot["name"], snapshot["state"]), ("4", None, "PROGRESS"))
+
+    def test_finished_task_only_gets_the_snapshot(self):
+        events = self.collect([], {"progress": "10", "total": "10"}, state="SUCCESS")
+
+        self.assertEqual(len(events), 1)
+
+    def test_stream_needs_an_async_server(self):
+        response = asyncio.run(task_progress_stream(RequestFactory().get("/"), "t1"))
+        self.assertEqual(response.status_code, 204)
+
+        response = asyncio.run(task_progress_stream(AsyncRequestFactory().get("/"), "t1"))
+        self.assertEqual(response["Content-Type"], "text/event-stream")
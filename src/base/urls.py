@@ -6,5 +6,6 @@ from . import views
 app_name = "backend"
 
 urlpatterns = [
-    path("task-progress/<str:task_id>", views.task_progress, name="task_progress")
+    path("task-progress/<str:task_id>", views.task_progress, name="task_progress"),
+    path("task-progress-stream/<str:task_id>", views.task_progress_stream, name="task_progress_stream"),
 ]
\ No newline at end of file
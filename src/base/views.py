@@ -1,22 +1,35 @@
-import redis
+import json
+import time
+
+import redis.asyncio as aioredis
+from asgiref.sync import sync_to_async
+from celery import states
 from celery.result import AsyncResult
-from django.http import JsonResponse
+from django.core.handlers.asgi import ASGIRequest
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from django.shortcuts import render
 
 from PaulStudios import settings
+from PaulStudios.celery import app
+from base.tasks import get_progress_fields, progress_key
 
-redis_db = redis.from_url(settings.REDIS_URL, decode_responses=True)
+PROGRESS_FIELDS = ("progress", "total", "image", "current", "name")
+# A stream is closed after this many seconds and the browser reconnects,
+# so abandoned pages do not hold a connection forever.
+STREAM_TIMEOUT = 10 * 60
+HEARTBEAT_INTERVAL = 15
 
 
 def task_progress(request, task_id):
     result = AsyncResult(task_id)
     try:
+        progress = get_progress_fields(task_id)
         response_data = {
-            'progress': redis_db.get(f"progress-{task_id}"),
-            'total': redis_db.get(f"total-{task_id}"),
-            'image': redis_db.get(f"image-{task_id}"),
-            'current': redis_db.get(f"current-{task_id}"),
-            'name': redis_db.get(f"name-{task_id}"),
+            'progress': progress.get('progress'),
+            'total': progress.get('total'),
+            'image': progress.get('image'),
+            'current': progress.get('current'),
+            'name': progress.get('name'),
             'state': result.state,
             'details': result.info,
         }
@@ -26,6 +39,66 @@ def task_progress(request, task_id):
         return JsonResponse({'error': str(e)})
 
 
+def task_state(task_id):
+    result = AsyncResult(task_id)
+    return {'state': result.state, 'details': result.info}
+
+
+def sse_event(data):
+    return f"data: {json.dumps(data, default=str)}\n\n"
+
+
+async def progress_events(task_id):
+    """Yield the progress of a task as server-sent events.
+
+    The first event is the full snapshot, the ones after it carry only the
+    fields that changed. Progress fields come from the updates published by
+    ``base.tasks``, the state from the messages the Celery result backend
+    publishes on every state change. Both live on the same Redis server.
+    """
+    client = aioredis.from_url(settings.REDIS_URL, decode_responses=True)
+    pubsub = client.pubsub()
+    progress_channel = progress_key(task_id)
+    state_channel = app.backend.get_key_for_task(task_id).decode()
+    try:
+        # Subscribe before reading the snapshot so no update falls in between.
+        await pubsub.subscribe(progress_channel, state_channel)
+        progress = await client.hgetall(progress_channel)
+        sent = {field: progress.get(field) for field in PROGRESS_FIELDS}
+        sent.update(await sync_to_async(task_state, thread_sensitive=False)(task_id))
+        yield sse_event(sent)
+
+        deadline = time.monotonic() + STREAM_TIMEOUT
+        while sent['state'] not in states.READY_STATES and time.monotonic() < deadline:
+            message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=HEARTBEAT_INTERVAL)
+            if message is None:
+                yield ": keep-alive\n\n"
+                continue
+            if message['channel'] == progress_channel:
+                update = json.loads(message['data'])
+            else:
+                meta = json.loads(message['data'])
+                update = {'state': meta['status'], 'details': meta['result']}
+            delta = {field: value for field, value in update.items() if sent.get(field) != value}
+            if delta:
+                sent.update(delta)
+                yield sse_event(delta)
+    finally:
+        await pubsub.aclose()
+        await client.aclose()
+
+
+async def task_progress_stream(request, task_id):
+    if not isinstance(request, ASGIRequest):
+        # A WSGI server would buffer the whole stream. 204 makes EventSource
+        # give up at once, and the page falls back to polling.
+        return HttpResponse(status=204)
+    response = StreamingHttpResponse(progress_events(task_id), content_type="text/event-stream")
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
 def custom_403(request, exception):
     return render(request, 'base/403.html', status=403)
 
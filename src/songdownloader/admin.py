@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import SpotifySong, SpotifyPlaylist, UserHistory, YouTubeSong, YouTubePlaylist
+from .models import SpotifySong, SpotifyPlaylist, TrackResolution, UserHistory, YouTubeSong, YouTubePlaylist
 
 
 class SongAdmin(admin.ModelAdmin):
@@ -12,8 +12,14 @@ class PlaylistAdmin(admin.ModelAdmin):
     search_fields = ('name', 'id')
 
 
+class ResolutionAdmin(admin.ModelAdmin):
+    list_display = ('key', 'youtube_video_id', 'expires')
+    search_fields = ('key', 'youtube_video_id')
+
+
 admin.site.register(SpotifySong, SongAdmin)
 admin.site.register(SpotifyPlaylist, PlaylistAdmin)
 admin.site.register(YouTubeSong, SongAdmin)
 admin.site.register(YouTubePlaylist, PlaylistAdmin)
 admin.site.register(UserHistory)
+admin.site.register(TrackResolution, ResolutionAdmin)
@@ -0,0 +1,39 @@
+import json
+import os
+import time
+
+from django.core.management.base import BaseCommand
+
+from songdownloader.services import artists
+
+CORPUS_PATH = os.path.join(os.path.dirname(artists.__file__), os.pardir, "data", "artist_corpus.json")
+
+
+class Command(BaseCommand):
+    help = "Measure artist extraction throughput and accuracy over a corpus of YouTube videos"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--corpus", default=CORPUS_PATH)
+        parser.add_argument("--repeat", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        with open(options["corpus"], encoding="utf-8") as fh:
+            corpus = json.load(fh)
+        videos = [(entry["title"], entry["description"], entry["tags"]) for entry in corpus]
+
+        # Warm the word list so the first pass does not pay for mapping it.
+        results = artists.extract_artists(videos)
+
+        start = time.perf_counter()
+        for _ in range(options["repeat"]):
+            artists.extract_artists(videos)
+        elapsed = time.perf_counter() - start
+
+        misses = [(entry, result) for entry, result in zip(corpus, results) if result != entry["artist"]]
+        for entry, result in misses:
+            self.stdout.write(f"{entry['title']!r}: expected {entry['artist']!r}, got {result!r}")
+
+        total = len(videos) * options["repeat"]
+        self.stdout.write(f"Throughput: {total / elapsed:,.0f} videos/s ({total} videos in {elapsed:.3f}s)")
+        self.stdout.write(f"Accuracy: {len(corpus) - len(misses)}/{len(corpus)} "
+                          f"({(len(corpus) - len(misses)) / len(corpus):.0%})")
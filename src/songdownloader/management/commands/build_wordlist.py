@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from songdownloader.services import wordlist
+
+
+class Command(BaseCommand):
+    help = "Download the English word lists and write the compact file used to filter artist names"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--output", default=wordlist.WORDLIST_PATH)
+
+    def handle(self, *args, **options):
+        count = wordlist.build(options["output"])
+        self.stdout.write(self.style.SUCCESS(f"Wrote {count} words to {options['output']}"))
@@ -0,0 +1,26 @@
+# Generated by Django 5.0.6 on 2026-10-18 13:12
+
+import django.db.models.functions.datetime
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('songdownloader', '0007_rename_spotify_id_spotifyplaylist_id_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TrackResolution',
+            fields=[
+                ('key', models.CharField(max_length=500, primary_key=True, serialize=False)),
+                ('youtube_video_id', models.CharField(blank=True, max_length=120, null=True)),
+                ('created', models.DateTimeField(auto_now_add=True, db_default=django.db.models.functions.datetime.Now(), verbose_name='Creation Date-Time')),
+                ('expires', models.DateTimeField(db_index=True, verbose_name='Expiry Date-Time')),
+            ],
+            options={
+                'verbose_name': 'Track Resolution',
+            },
+        ),
+    ]
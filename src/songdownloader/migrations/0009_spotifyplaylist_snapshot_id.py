@@ -0,0 +1,18 @@
+# Generated by Django 5.0.6 on 2026-10-18 13:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('songdownloader', '0008_trackresolution'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='spotifyplaylist',
+            name='snapshot_id',
+            field=models.CharField(blank=True, default='', max_length=120),
+        ),
+    ]
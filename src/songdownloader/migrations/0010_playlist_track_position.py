@@ -0,0 +1,93 @@
+# Generated by Django 5.0.6 on 2026-10-18 13:15
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def copy_memberships(playlist_model, entry_model, song_field):
+    # Old memberships have no order; number them by insertion order.
+    def forwards(apps, schema_editor):
+        Playlist = apps.get_model('songdownloader', playlist_model)
+        Entry = apps.get_model('songdownloader', entry_model)
+        Through = Playlist.tracks.through
+        positions = {}
+        entries = []
+        for row in Through.objects.order_by('id').iterator():
+            playlist_id = getattr(row, f"{playlist_model.lower()}_id")
+            positions[playlist_id] = positions.get(playlist_id, 0) + 1
+            entries.append(Entry(playlist_id=playlist_id, song_id=getattr(row, f"{song_field}_id"),
+                                 position=positions[playlist_id]))
+        Entry.objects.bulk_create(entries, batch_size=500)
+    return forwards
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('songdownloader', '0009_spotifyplaylist_snapshot_id'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SpotifyPlaylistTrack',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('position', models.PositiveIntegerField()),
+                ('playlist', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='entries', to='songdownloader.spotifyplaylist')),
+                ('song', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='songdownloader.spotifysong')),
+            ],
+            options={
+                'verbose_name': 'Spotify Playlist Track',
+                'ordering': ['position'],
+            },
+        ),
+        migrations.RunPython(copy_memberships('SpotifyPlaylist', 'SpotifyPlaylistTrack', 'spotifysong'), migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='spotifyplaylist',
+            name='tracks',
+        ),
+        migrations.AddField(
+            model_name='spotifyplaylist',
+            name='tracks',
+            field=models.ManyToManyField(through='songdownloader.SpotifyPlaylistTrack', to='songdownloader.spotifysong'),
+        ),
+        migrations.CreateModel(
+            name='YouTubePlaylistTrack',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('position', models.PositiveIntegerField()),
+                ('playlist', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='entries', to='songdownloader.youtubeplaylist')),
+                ('song', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='songdownloader.youtubesong')),
+            ],
+            options={
+                'verbose_name': 'YouTube Playlist Track',
+                'ordering': ['position'],
+            },
+        ),
+        migrations.RunPython(copy_memberships('YouTubePlaylist', 'YouTubePlaylistTrack', 'youtubesong'), migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='youtubeplaylist',
+            name='tracks',
+        ),
+        migrations.AddField(
+            model_name='youtubeplaylist',
+            name='tracks',
+            field=models.ManyToManyField(through='songdownloader.YouTubePlaylistTrack', to='songdownloader.youtubesong'),
+        ),
+        migrations.AddIndex(
+            model_name='spotifyplaylisttrack',
+            index=models.Index(fields=['playlist', 'position'], name='spotify_playlist_position'),
+        ),
+        migrations.AddConstraint(
+            model_name='spotifyplaylisttrack',
+            constraint=models.UniqueConstraint(fields=('playlist', 'song'), name='unique_spotify_playlist_song'),
+        ),
+        migrations.AddIndex(
+            model_name='youtubeplaylisttrack',
+            index=models.Index(fields=['playlist', 'position'], name='youtube_playlist_position'),
+        ),
+        migrations.AddConstraint(
+            model_name='youtubeplaylisttrack',
+            constraint=models.UniqueConstraint(fields=('playlist', 'song'), name='unique_youtube_playlist_song'),
+        ),
+    ]
@@ -43,17 +43,40 @@ class SpotifySong(models.Model):
 class SpotifyPlaylist(models.Model):
     id = models.CharField(max_length=120, primary_key=True)
     name = models.CharField(max_length=120)
+    snapshot_id = models.CharField(max_length=120, blank=True, default="")
     image = models.ImageField(upload_to="playlists")
-    tracks = models.ManyToManyField(SpotifySong)
+    tracks = models.ManyToManyField(SpotifySong, through="SpotifyPlaylistTrack")
     created = models.DateTimeField("Creation Date-Time", db_default=Now(), auto_now_add=True)
 
     def __str__(self):
         return f"{self.name}  -  [{self.id}]"
 
+    def ordered_tracks(self):
+        return [(entry.position, entry.song) for entry in self.entries.select_related("song")]
+
     class Meta:
         verbose_name = 'Spotify Playlist'
 
 
+class SpotifyPlaylistTrack(models.Model):
+    playlist = models.ForeignKey(SpotifyPlaylist, on_delete=models.CASCADE, related_name="entries")
+    song = models.ForeignKey(SpotifySong, on_delete=models.CASCADE)
+    position = models.PositiveIntegerField()
+
+    def __str__(self):
+        return f"{self.position}. {self.song.name}  -  [{self.playlist_id}]"
+
+    class Meta:
+        verbose_name = 'Spotify Playlist Track'
+        ordering = ['position']
+        constraints = [
+            models.UniqueConstraint(fields=['playlist', 'song'], name='unique_spotify_playlist_song'),
+        ]
+        indexes = [
+            models.Index(fields=['playlist', 'position'], name='spotify_playlist_position'),
+        ]
+
+
 class UserHistory(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     user = models.ForeignKey(User, on_delete=models.CASCADE)
@@ -88,11 +111,47 @@ class YouTubePlaylist(models.Model):
     id = models.CharField(max_length=120, primary_key=True)
     name = models.CharField(max_length=120)
     image = models.ImageField(upload_to="playlists")
-    tracks = models.ManyToManyField(YouTubeSong)
+    tracks = models.ManyToManyField(YouTubeSong, through="YouTubePlaylistTrack")
     created = models.DateTimeField("Creation Date-Time", db_default=Now(), auto_now_add=True)
 
     def __str__(self):
         return f"{self.name}  -  [{self.id}]"
 
+    def ordered_tracks(self):
+        return [(entry.position, entry.song) for entry in self.entries.select_related("song")]
+
     class Meta:
         verbose_name = 'YouTube Playlist'
+
+
+class YouTubePlaylistTrack(models.Model):
+    playlist = models.ForeignKey(YouTubePlaylist, on_delete=models.CASCADE, related_name="entries")
+    song = models.ForeignKey(YouTubeSong, on_delete=models.CASCADE)
+    position = models.PositiveIntegerField()
+
+    def __str__(self):
+        return f"{self.position}. {self.song.name}  -  [{self.playlist_id}]"
+
+    class Meta:
+        verbose_name = 'YouTube Playlist Track'
+        ordering = ['position']
+        constraints = [
+            models.UniqueConstraint(fields=['playlist', 'song'], name='unique_youtube_playlist_song'),
+        ]
+        indexes = [
+            models.Index(fields=['playlist', 'position'], name='youtube_playlist_position'),
+        ]
+
+
+class TrackResolution(models.Model):
+    # Outlives SpotifySong rows, which are removed a day after each job.
+    key = models.CharField(max_length=500, primary_key=True)
+    youtube_video_id = models.CharField(max_length=120, null=True, blank=True)
+    created = models.DateTimeField("Creation Date-Time", db_default=Now(), auto_now_add=True)
+    expires = models.DateTimeField("Expiry Date-Time", db_index=True)
+
+    def __str__(self):
+        return f"{self.key}  -  [{self.youtube_video_id}]"
+
+    class Meta:
+        verbose_name = 'Track Resolution'
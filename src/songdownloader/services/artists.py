@@ -0,0 +1,67 @@
+import re
+from functools import lru_cache
+
+from songdownloader.services.wordlist import english_words
+
+UNKNOWN_ARTIST = "Unknown"
+
+# One pass over the whole description. Lines are tried top to bottom and a
+# labelled credit ("Singer: ...", "Music - ...") wins over "by ..." on the
+# same line.
+DESCRIPTION_PATTERN = re.compile(r"""
+    ^.*?\b(?:artists?|singers?|music)\s*[:-]\s*(?P<label>.+)$
+  | ^.*?\bby\s+(?P<by>.+?)(?:\s+performing\b.*)?$   # 'Music video by Artist performing Song.'
+""", re.IGNORECASE | re.MULTILINE | re.VERBOSE)
+
+# Alternatives are all anchored at the start, so they are tried in the
+# order listed.
+TITLE_PATTERN = re.compile(r"""
+    ^(?P<topic>.+?)\s+-\s+topic$                    # 'Artist - Topic'
+  | ^[^|]*\|\s*(?P<pipe>[^|]+?)\s*(?:\|.*)?$        # 'Title | Artist' and 'Title | Artist | Label'
+  | ^"[^"]+"\s+by\s+(?P<quoted>.+)$                 # '"Song" by Artist'
+  | ^(?P<colon>[^:]+?):\s.+$                        # 'Artist: Title'
+  | ^.+?\s-\s(?P<dash>.+)$                          # 'Title - Artist'
+""", re.IGNORECASE | re.VERBOSE)
+
+TAG_PATTERN = re.compile(r"^\s*artists?\b\s*[:-]?\s*(.*)$", re.IGNORECASE)
+
+
+@lru_cache(maxsize=65536)
+def is_common_word(word):
+    return english_words.lookup(word)
+
+
+def is_name(candidate):
+    # A candidate made only of dictionary words is a phrase, not a name.
+    words = candidate.lower().split()
+    return bool(words) and not all(is_common_word(word) for word in words)
+
+
+def _candidates(title, description, tags):
+    for match in DESCRIPTION_PATTERN.finditer(description or ""):
+        yield match.group(match.lastgroup)
+    match = TITLE_PATTERN.search(title or "")
+    if match:
+        yield match.group(match.lastgroup)
+    for tag in tags or ():
+        if "artist" in tag.lower():
+            match = TAG_PATTERN.match(tag)
+            yield match.group(1) if match else tag
+
+
+def extract_artist(title, description, tags):
+    """Best guess at the artist of a YouTube video, or ``UNKNOWN_ARTIST``.
+
+    The description is checked first, then the title, then the tags. The
+    first candidate that is not just common English words is returned.
+    """
+    for candidate in _candidates(title, description, tags):
+        candidate = candidate.strip()
+        if is_name(candidate):
+            return candidate
+    return UNKNOWN_ARTIST
+
+
+def extract_artists(videos):
+    """:func:`extract_artist` for each ``(title, description, tags)`` in ``videos``."""
+    return [extract_artist(title, description, tags) for title, description, tags in videos]
@@ -0,0 +1,149 @@
+import os
+import shutil
+import sqlite3
+import threading
+import time
+
+from celery.utils.log import get_task_logger
+
+from PaulStudios import settings
+from songdownloader.services.singleflight import SingleFlight
+
+logging = get_task_logger(__name__)
+
+# Part of every cache key. Change it whenever download_youtube_mp3 starts
+# picking a different stream, so old files are not served for the new format.
+AUDIO_FORMAT = "audio-first"
+
+
+class AudioCache:
+    """On-disk audio cache shared by every job on this host.
+
+    Files live in ``folder`` and are indexed in a small SQLite database next
+    to them, so all Celery processes see the same entries. Once the total
+    size goes over ``max_bytes`` the least recently used files are evicted.
+    """
+
+    def __init__(self, folder, max_bytes):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self._index_path = os.path.join(folder, "index.sqlite3")
+        self._fills = SingleFlight()
+
+    @staticmethod
+    def key(video_id, audio_format=AUDIO_FORMAT):
+        return f"{video_id}.{audio_format}"
+
+    def _connect(self):
+        os.makedirs(self.folder, exist_ok=True)
+        conn = sqlite3.connect(self._index_path, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "key TEXT PRIMARY KEY, path TEXT NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL)"
+        )
+        return conn
+
+    def get(self, key):
+        conn = self._connect()
+        try:
+            row = conn.execute("SELECT path FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if not os.path.exists(row[0]):
+                conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+                return None
+            conn.execute("UPDATE entries SET last_access = ? WHERE key = ?", (time.time(), key))
+            return row[0]
+        finally:
+            conn.close()
+
+    def put(self, key, file_path):
+        path = os.path.join(self.folder, key + os.path.splitext(file_path)[1])
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        conn = self._connect()
+        try:
+            if not link_file(file_path, temp_path):
+                return None
+            os.replace(temp_path, path)
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute(
+                "INSERT OR REPLACE INTO entries (key, path, size, last_access) VALUES (?, ?, ?, ?)",
+                (key, path, os.stat(path).st_size, time.time()),
+            )
+            self._evict(conn)
+            conn.execute("COMMIT")
+            return path
+        finally:
+            conn.close()
+
+    def _evict(self, conn):
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, path, size in conn.execute("SELECT key, path, size FROM entries ORDER BY last_access").fetchall():
+            if total <= self.max_bytes:
+                break
+            conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            logging.info(f"Evicted {key} from audio cache")
+
+    def fetch(self, key, dest, fill):
+        """Link the cached file for ``key`` to ``dest``, or call ``fill()`` to
+        create ``dest`` and cache it. Concurrent fetches of the same key in
+        this process wait for a single ``fill()``.
+
+        Returns ``(size, cached)``.
+        """
+        path = self.get(key)
+        if path and link_file(path, dest):
+            return os.stat(dest).st_size, True
+
+        filled = []
+
+        def fill_and_cache():
+            filled.append(True)
+            size = fill()
+            try:
+                self.put(key, dest)
+            except (OSError, sqlite3.Error) as e:
+                logging.warning(f"Could not add {key} to audio cache: {e}")
+            return size
+
+        try:
+            size = self._fills.run(key, fill_and_cache)
+        except Exception:
+            if filled:
+                raise
+            size = None
+        if filled:
+            return size, False
+
+        # Another fetch filled its own destination; take the copy it cached,
+        # or fill this one too when that did not work out.
+        path = self.get(key)
+        if path and link_file(path, dest):
+            return os.stat(dest).st_size, True
+        return fill_and_cache(), False
+
+
+def link_file(src, dest):
+    # Hardlink when src and dest share a filesystem, copy otherwise.
+    try:
+        if os.path.exists(dest):
+            os.remove(dest)
+        os.link(src, dest)
+    except OSError:
+        try:
+            shutil.copyfile(src, dest)
+        except OSError:
+            return False
+    return True
+
+
+audio_cache = AudioCache(settings.SONGDOWNLOADER_AUDIO_CACHE_DIR,
+                         settings.SONGDOWNLOADER_AUDIO_CACHE_MAX_MB * 1024 * 1024)
@@ -2,27 +2,28 @@ import logging as lg
 import os
 import shutil
 import queue
-import tempfile
 import threading
 import time
 import zipfile
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
 
 import requests
+from celery.signals import worker_process_shutdown
 from celery.utils.log import get_task_logger
-from django.core.files import File
 from pytube import YouTube
 from pytube.exceptions import PytubeError
 
 from PaulStudios import settings
 from base.tasks import increase_progress
+from songdownloader.services.audio_cache import audio_cache
 
 MAX_SIMULTANEOUS_DOWNLOADS = 12
 MAX_RETRIES = 3
-
-download_queue = queue.Queue()
-successful_downloads = []
-failed_downloads = []
-lock = threading.Lock()
+DOWNLOAD_QUEUE_SIZE = MAX_SIMULTANEOUS_DOWNLOADS * 4
+RESOLVE_WINDOW = 32
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+YOUTUBE_RANGE_SIZE = 9 * 1024 * 1024
+STORED_EXTENSIONS = {".mp3", ".m4a", ".mp4", ".webm", ".ogg", ".opus", ".aac"}
 
 # Configure logging
 logging = get_task_logger(__name__)
@@ -30,83 +31,133 @@ lg.basicConfig(level=lg.INFO)
 
 mode = settings.MODE
 
-def zip_files(file_paths, zip_name, folder):
-    logging.info(f"Zipping {zip_name}")
-    try:
-        zip_path = os.path.join(folder, zip_name)
-        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-            for file_path in file_paths:
-                if os.path.exists(file_path):
-                    logging.info(f"Adding {file_path.split('/')[-1]} to {zip_path.split('/')[-1]}")
-                    zipf.write(file_path, os.path.basename(file_path))
-                    os.remove(file_path)
-                else:
-                    logging.error(f"File not found, skipping: {file_path.split('/')[-1]}")
-        logging.info(f"ZIP file created successfully: {zip_path.split('/')[-1]}")
-    except Exception as e:
-        logging.error(f"USER : {zip_path.split('/')[2]} \nFailed to create ZIP file {zip_path.split('/')[-1]}: {e}")
-        raise
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    # Created lazily so every forked Celery process gets its own threads,
+    # which are then reused by every download session in that process.
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=MAX_SIMULTANEOUS_DOWNLOADS,
+                                           thread_name_prefix="downloader")
+    return _executor
+
+
+@worker_process_shutdown.connect
+def shutdown_executor(**kwargs):
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=False, cancel_futures=True)
+            _executor = None
+
+
+class ZipWriter:
+    """Appends finished tracks to the job's archive from its own thread.
+
+    Audio is already compressed, so it is stored as is; anything else is
+    deflated. The archive is only created once the first file arrives.
+    """
 
-def download_file(url, name, folder, zip_name, task_id, auth=None):
-    retries = 0
-    error_message = ""
-    while retries < MAX_RETRIES:
+    def __init__(self, zip_path):
+        self.zip_path = zip_path
+        self.error = None
+        self._queue = queue.Queue()
+        self._zipf = None
+        self._thread = threading.Thread(target=self._run, name="zip-writer", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def add(self, file_path):
+        self._queue.put(file_path)
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        if self.error:
+            raise self.error
+
+    def _run(self):
         try:
-            logging.info(f"Starting download: {url}")
-            start_time = time.time()
-
-            if "youtube.com" in url or "youtu.be" in url:
-                download_youtube_mp3(url, name, os.path.join(folder, zip_name))
-                file_path = os.path.join(folder, zip_name, name + ".mp3")
-                with open(file_path, "rb") as f:
-                    content = f.read()
-            else:
-                response = requests.get(url, timeout=10, auth=auth)
-                response.raise_for_status()
-                file_name = name or url.split('/')[-1]
-                file_path = os.path.join(folder, file_name)
-                with open(file_path, 'wb') as f:
-                    f.write(response.content)
-                content = response.content
-
-            end_time = time.time()
-            download_time = end_time - start_time
-            file_size = len(content) / (1024 * 1024) if content else 0
-            download_speed = file_size / download_time if file_size > 0 else 0
-            logging.info(
-                f"Download successful: {url}, Size: {file_size:.2f} MB, Time: {download_time:.2f} s, Speed: {download_speed:.2f} MB/s")
-            with lock:
-                successful_downloads.append(file_path)
-            if not retries >= 1:
-                increase_progress(task_id)
-            return True
-        except (requests.RequestException, PytubeError) as e:
-            if not retries >= 1:
-                increase_progress(task_id)
-            retries += 1
-            error_message = str(e)
-            logging.warning(f"Retrying ({retries}/{MAX_RETRIES}) for {url}: {e}")
-            time.sleep(2 ** retries)
+            while True:
+                file_path = self._queue.get()
+                if file_path is None:
+                    break
+                self._write(file_path)
         except Exception as e:
-            logging.error(f"Unexpected error while downloading {url}: {e}")
-            if not retries >= 1:
-                increase_progress(task_id)
-            break
+            logging.error(f"USER : {self.zip_path.split('/')[2]} \nFailed to create ZIP file {self.zip_path.split('/')[-1]}: {e}")
+            self.error = e
+        finally:
+            if self._zipf is not None:
+                self._zipf.close()
+                logging.info(f"ZIP file created successfully: {self.zip_path.split('/')[-1]}")
+
+    def _write(self, file_path):
+        if not os.path.exists(file_path):
+            logging.error(f"File not found, skipping: {file_path.split('/')[-1]}")
+            return
+        if self._zipf is None:
+            logging.info(f"Zipping {self.zip_path.split('/')[-1]}")
+            self._zipf = zipfile.ZipFile(self.zip_path, 'w', zipfile.ZIP_DEFLATED)
+        ext = os.path.splitext(file_path)[1].lower()
+        compress_type = zipfile.ZIP_STORED if ext in STORED_EXTENSIONS else zipfile.ZIP_DEFLATED
+        logging.info(f"Adding {file_path.split('/')[-1]} to {self.zip_path.split('/')[-1]}")
+        self._zipf.write(file_path, os.path.basename(file_path), compress_type=compress_type)
+        os.remove(file_path)
+
+
+def save_stream(response, fh):
+    size = 0
+    for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+        fh.write(chunk)
+        size += len(chunk)
+    return size
+
+
+def job_folder(folder):
+    return os.path.join("songdownloader", f"media_{mode}", folder)
+
+
+def archive_name(zip_name):
+    return "[PaulStudios-SongDownloader] " + zip_name + ".zip"
+
+
+def zip_files(file_paths, zip_name, folder):
+    zip_path = os.path.join(folder, archive_name(zip_name))
+    writer = ZipWriter(zip_path).start()
+    for file_path in file_paths:
+        writer.add(file_path)
+    writer.close()
+    return zip_path
 
-    logging.error(f"Failed to download after {MAX_RETRIES} attempts: {url}")
-    with lock:
-        failed_downloads.append({"url": url, 'name': name, "error": error_message})
-    return False
 
 def download_youtube_mp3(url, name, folder):
     try:
         yt = YouTube(url)
         audio_stream = yt.streams.filter(only_audio=True).first()
-        out_file = audio_stream.download(output_path=folder, filename=name)
-        base, ext = os.path.splitext(out_file)
+        if not os.path.exists(folder):
+            os.makedirs(folder, exist_ok=True)
         new_file = os.path.join(folder, name + '.mp3')
-        os.rename(out_file, new_file)
+        total = audio_stream.filesize
+        size = 0
+        # Fetch in range windows like pytube does (YouTube throttles whole-file
+        # requests), but hand each window to disk chunk by chunk.
+        with open(new_file + ".part", "wb") as f:
+            for start in (range(0, total, YOUTUBE_RANGE_SIZE) if total else [None]):
+                stream_url = audio_stream.url
+                if start is not None:
+                    stream_url += f"&range={start}-{min(start + YOUTUBE_RANGE_SIZE, total) - 1}"
+                with requests.get(stream_url, stream=True, timeout=10) as response:
+                    response.raise_for_status()
+                    size += save_stream(response, f)
+        os.replace(new_file + ".part", new_file)
         logging.info(f"Downloaded YouTube MP3: {name}")
+        return size
     except PytubeError as e:
         logging.error(f"Failed to download YouTube MP3: {url}, Error: {e}")
         raise
@@ -114,74 +165,201 @@ def download_youtube_mp3(url, name, folder):
         logging.error(f"Unexpected error while downloading YouTube MP3 {url}: {e}")
         raise
 
-def worker(folder, zip_name, task_id):
-    while True:
-        task = download_queue.get()
-        if task is None:
-            download_queue.task_done()
-            break
-        url = task.get('url')
-        auth = task.get('auth')
-        name = task.get('name')
+
+class DownloadSession:
+    """One download job with its own queue, results and stats.
+
+    Runs on the shared pool from ``get_executor()``. Every runner gives its
+    thread back after one track, so jobs on the same worker interleave.
+    """
+
+    def __init__(self, zip_name, folder, task_id, archive=True):
+        self.zip_name = zip_name
+        self.folder = job_folder(folder)
+        self.task_id = task_id
+        self.archive = archive
+        self.download_queue = queue.Queue(maxsize=DOWNLOAD_QUEUE_SIZE)
+        self.zip_path = None
+        self.queued = 0
+        self.successful_downloads = []
+        self.failed_downloads = []
+        self.stats = {"bytes": 0, "seconds": 0.0, "cache_hits": 0}
+        self._lock = threading.Lock()
+        self._runners = 0
+        self._writer = None
+        self._start_time = None
+        self._aborted = False
+
+    def start(self):
+        logging.info(f"Starting downloader for {self.zip_name}")
+        self._start_time = time.time()
+
+        os.makedirs(os.path.join(self.folder, self.zip_name), exist_ok=True)
+
+        if self.archive:
+            self.zip_path = os.path.join(self.folder, archive_name(self.zip_name))
+            self._writer = ZipWriter(self.zip_path).start()
+        return self
+
+    def put(self, task):
+        # Blocks while the queue is full, which holds back whoever is still
+        # producing tracks until the downloads catch up.
+        logging.debug(f"Queueing download: {task['url']}")
+        self.download_queue.put(task)
+        with self._lock:
+            self.queued += 1
+            start_runner = self._runners < MAX_SIMULTANEOUS_DOWNLOADS
+            if start_runner:
+                self._runners += 1
+        if start_runner:
+            get_executor().submit(self._run_one)
+
+    def finish(self):
+        self.download_queue.join()
+        if self._writer:
+            self._writer.close()
+
+        self.stats["seconds"] = time.time() - self._start_time
+        logging.info(f"Completed all tasks.")
+
+        download_list = [os.path.basename(i) for i in self.successful_downloads]
+        if self.failed_downloads:
+            logging.error("Failed downloads:")
+            for entry in self.failed_downloads:
+                logging.error(f"NAME: {entry['name']} URL: {entry['url']}, Error: {entry['error']}")
+        return download_list, self.failed_downloads, self.zip_path, self.folder
+
+    def abort(self):
+        """Give up on the job after an error.
+
+        Queued tracks are dropped and the partial archive is removed. Tracks
+        already downloading finish, but nothing new is started.
+        """
+        with self._lock:
+            self._aborted = True
+            while True:
+                try:
+                    self.download_queue.get_nowait()
+                except queue.Empty:
+                    break
+                self.download_queue.task_done()
+        if self._writer:
+            try:
+                self._writer.close()
+            except Exception as e:
+                logging.error(f"Error closing archive of aborted job {self.zip_name}: {e}")
+            if os.path.exists(self.zip_path):
+                os.remove(self.zip_path)
+        logging.info(f"Aborted downloader for {self.zip_name}")
+
+    def run(self, tasks):
+        self.start()
+        for task in tasks:
+            self.put(task)
+        return self.finish()
+
+    def _run_one(self):
+        with self._lock:
+            if self._aborted:
+                self._runners -= 1
+                return
+            try:
+                task = self.download_queue.get_nowait()
+            except queue.Empty:
+                self._runners -= 1
+                return
         try:
-            download_file(url, name, folder, zip_name, task_id, auth)
+            self.download_file(task.get('url'), task.get('name'), task.get('auth'), task.get('video_id'))
         except Exception as e:
             logging.error(f"Error in worker thread: {e}")
         finally:
-            download_queue.task_done()
-
-def downloader(tasks, zip_name, folder, task_id):
-    threads = []
+            self.download_queue.task_done()
+        # Go to the back of the pool's queue so other sessions get a turn.
+        get_executor().submit(self._run_one)
 
-    logging.info(f"Starting downloader with {len(tasks)} tasks for {zip_name}")
+    def download_file(self, url, name, auth=None, video_id=None):
+        retries = 0
+        error_message = ""
+        while retries < MAX_RETRIES:
+            try:
+                logging.info(f"Starting download: {url}")
+                start_time = time.time()
 
-    folder = os.path.join("songdownloader", f"media_{mode}", folder)
-    if not os.path.exists(folder):
-        os.makedirs(folder)
+                cached = False
+                if "youtube.com" in url or "youtu.be" in url:
+                    folder = os.path.join(self.folder, self.zip_name)
+                    file_path = os.path.join(folder, name + ".mp3")
+                    if video_id:
+                        size, cached = audio_cache.fetch(audio_cache.key(video_id), file_path,
+                                                         lambda: download_youtube_mp3(url, name, folder))
+                    else:
+                        size = download_youtube_mp3(url, name, folder)
+                else:
+                    file_name = name or url.split('/')[-1]
+                    file_path = os.path.join(self.folder, file_name)
+                    with requests.get(url, timeout=10, auth=auth, stream=True) as response:
+                        response.raise_for_status()
+                        with open(file_path, 'wb') as f:
+                            size = save_stream(response, f)
 
-    for _ in range(MAX_SIMULTANEOUS_DOWNLOADS):
-        t = threading.Thread(target=worker, args=(folder, zip_name, task_id, ))
-        t.start()
-        threads.append(t)
+                end_time = time.time()
+                download_time = end_time - start_time
+                file_size = size / (1024 * 1024)
+                download_speed = file_size / download_time if file_size > 0 else 0
+                if cached:
+                    logging.info(f"Download served from cache: {url}, Size: {file_size:.2f} MB")
+                else:
+                    logging.info(
+                        f"Download successful: {url}, Size: {file_size:.2f} MB, Time: {download_time:.2f} s, Speed: {download_speed:.2f} MB/s")
+                with self._lock:
+                    self.successful_downloads.append(file_path)
+                    if cached:
+                        self.stats["cache_hits"] += 1
+                    else:
+                        self.stats["bytes"] += size
+                if self._writer:
+                    self._writer.add(file_path)
+                if not retries >= 1:
+                    increase_progress(self.task_id)
+                return True
+            except (requests.RequestException, PytubeError) as e:
+                if not retries >= 1:
+                    increase_progress(self.task_id)
+                retries += 1
+                error_message = str(e)
+                logging.warning(f"Retrying ({retries}/{MAX_RETRIES}) for {url}: {e}")
+                time.sleep(2 ** retries)
+            except Exception as e:
+                logging.error(f"Unexpected error while downloading {url}: {e}")
+                if not retries >= 1:
+                    increase_progress(self.task_id)
+                break
 
-    for task in tasks:
-        logging.debug(f"Queueing download: {task['url']}")
-        download_queue.put(task)
+        logging.error(f"Failed to download after {MAX_RETRIES} attempts: {url}")
+        with self._lock:
+            self.failed_downloads.append({"url": url, 'name': name, "error": error_message})
+        return False
 
-    download_queue.join()
 
-    for _ in range(MAX_SIMULTANEOUS_DOWNLOADS):
-        download_queue.put(None)
-    for t in threads:
-        t.join()
-    
-    zip_name = "[PaulStudios-SongDownloader] " + zip_name + ".zip"
+def downloader(tasks, zip_name, folder, task_id):
+    return DownloadSession(zip_name, folder, task_id).run(tasks)
 
-    if successful_downloads:
-        logging.info(f"Creating ZIP file: {zip_name}")
-        zip_files(successful_downloads, zip_name, folder)
-        logging.info(f"Completed all tasks.")
 
-    download_list = [os.path.basename(i) for i in successful_downloads]
-    if failed_downloads:
-        logging.error("Failed downloads:")
-        for entry in failed_downloads:
-            logging.error(f"NAME: {entry['name']} URL: {entry['url']}, Error: {entry['error']}")
-        return download_list, failed_downloads, os.path.join(folder, zip_name), folder
-    else:
-        return download_list, [], os.path.join(folder, zip_name), folder
-
-
-def process_image(obj, url):
-    response = requests.get(url)
-    temp_image = tempfile.NamedTemporaryFile(delete=False)
-    temp_image.write(response.content)
-    temp_image.flush()
-    image = temp_image.name
-    with open(image, "rb") as image_file:
-        django_file = File(image_file)
-        obj.image.save(f"{str(obj.id)}.jpg", django_file, save=True)
-    os.remove(temp_image.name)
+def run_bounded(fn, items, window=RESOLVE_WINDOW):
+    """Call ``fn(*args)`` for every tuple in ``items`` on a thread pool and
+    yield ``(position, result)`` as calls complete, with at most ``window``
+    calls in flight. Positions start at 1.
+    """
+    with ThreadPoolExecutor() as executor:
+        pending = {}
+        for position, args in enumerate(items, 1):
+            pending[executor.submit(fn, *args)] = position
+            if len(pending) >= window:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield pending.pop(future), future.result()
+        for future in as_completed(list(pending)):
+            yield pending.pop(future), future.result()
 
 
 def make_yt_link(video_id):
@@ -0,0 +1,130 @@
+import hashlib
+import io
+import logging
+import mimetypes
+import re
+
+import redis
+import requests
+from PIL import Image
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from requests.adapters import HTTPAdapter
+
+from PaulStudios import settings
+from songdownloader.models import SpotifyPlaylist, SpotifySong, YouTubePlaylist, YouTubeSong
+from songdownloader.services.singleflight import SingleFlight
+
+logger = logging.getLogger("Services.Images")
+redis_db = redis.from_url(settings.REDIS_URL, decode_responses=True)
+
+RENDITION_SIZE = settings.SONGDOWNLOADER_IMAGE_SIZE
+RENDITION_FORMAT = settings.SONGDOWNLOADER_IMAGE_FORMAT
+RENDITION_EXTENSIONS = {"WEBP": "webp", "JPEG": "jpg"}
+ORIGINAL_EXTENSIONS = {"JPEG": "jpg", "PNG": "png", "WEBP": "webp", "GIF": "gif"}
+# Seconds an image handed out by process_image() is kept from release_image(),
+# which covers rows that are only saved later by a bulk insert.
+IN_USE_TTL = 30 * 60
+FETCH_TIMEOUT = (5, 30)
+# Matches the number of tracks resolved at once, which all fetch covers.
+POOL_SIZE = 32
+RENDITION_PATTERN = re.compile(r"^(?P<folder>.+)/(?P<key>[0-9a-f]{24})-\d+\.\w+$")
+
+http = requests.Session()
+http.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=POOL_SIZE))
+
+_fetches = SingleFlight()
+
+
+def image_names(folder, url, extension="jpg"):
+    # Songs from the same album share one cover URL, so they share the files.
+    key = hashlib.sha1(url.encode()).hexdigest()[:24]
+    rendition = f"{folder}/{key}-{RENDITION_SIZE}.{RENDITION_EXTENSIONS[RENDITION_FORMAT]}"
+    return f"{folder}/{key}.{extension}", rendition
+
+
+def image_lock(name):
+    return redis_db.lock(f"image-lock-{name}", timeout=10)
+
+
+def mark_in_use(name):
+    redis_db.set(f"image-in-use-{name}", 1, ex=IN_USE_TTL)
+
+
+def original_extension(response):
+    try:
+        return ORIGINAL_EXTENSIONS[Image.open(io.BytesIO(response.content)).format]
+    except (OSError, KeyError):
+        content_type = response.headers.get("Content-Type", "").split(";")[0].strip()
+        extension = mimetypes.guess_extension(content_type)
+        return extension[1:] if extension else "jpg"
+
+
+def make_rendition(content):
+    image = Image.open(io.BytesIO(content)).convert("RGB")
+    image.thumbnail((RENDITION_SIZE, RENDITION_SIZE))
+    buffer = io.BytesIO()
+    image.save(buffer, RENDITION_FORMAT, quality=80)
+    return buffer.getvalue()
+
+
+def save_file(name, content):
+    saved = default_storage.save(name, ContentFile(content))
+    if saved != name:
+        # Another process stored the same image first.
+        default_storage.delete(saved)
+
+
+def store_image(folder, url):
+    rendition = image_names(folder, url)[1]
+    # Marked under the lock, so release_image() cannot delete the file
+    # between this check and the row that uses it being saved.
+    with image_lock(rendition):
+        mark_in_use(rendition)
+        if default_storage.exists(rendition):
+            return rendition
+
+    response = http.get(url, timeout=FETCH_TIMEOUT)
+    response.raise_for_status()
+    original = image_names(folder, url, original_extension(response))[0]
+    save_file(original, response.content)
+    try:
+        save_file(rendition, make_rendition(response.content))
+    except (OSError, ValueError) as e:
+        logger.warning(f"Could not resize {url}: {e}")
+        mark_in_use(original)
+        return original
+    return rendition
+
+
+def fetch_once(folder, url):
+    # Concurrent requests for the same image in this process share one fetch.
+    return _fetches.run((folder, url), lambda: store_image(folder, url))
+
+
+def process_image(obj, url, save=True):
+    obj.image.name = fetch_once(obj._meta.get_field("image").upload_to, url)
+    if save:
+        obj.save()
+
+
+def release_image(name):
+    """Delete an image, and its original, once no song or playlist uses it.
+
+    Returns False without deleting anything when the image was handed out in
+    the last IN_USE_TTL seconds, as the rows using it may not be saved yet.
+    """
+    if not name:
+        return True
+    with image_lock(name):
+        if redis_db.exists(f"image-in-use-{name}"):
+            return False
+        if any(model.objects.filter(image=name).exists()
+               for model in (SpotifySong, SpotifyPlaylist, YouTubeSong, YouTubePlaylist)):
+            return True
+        default_storage.delete(name)
+        match = RENDITION_PATTERN.match(name)
+        if match:
+            for extension in set(ORIGINAL_EXTENSIONS.values()):
+                default_storage.delete(f"{match['folder']}/{match['key']}.{extension}")
+    return True
@@ -0,0 +1,111 @@
+import logging
+import time
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+import redis
+from googleapiclient.http import HttpRequest
+
+from PaulStudios import settings
+
+logger = logging.getLogger("Services.Quota")
+redis_db = redis.from_url(settings.REDIS_URL, decode_responses=True)
+
+DAILY_QUOTA = settings.SONGDOWNLOADER_YOUTUBE_DAILY_QUOTA
+LOW_QUOTA = settings.SONGDOWNLOADER_YOUTUBE_QUOTA_LOW
+RATE = settings.SONGDOWNLOADER_YOUTUBE_RATE
+BURST = settings.SONGDOWNLOADER_YOUTUBE_BURST
+MAX_WAIT = settings.SONGDOWNLOADER_YOUTUBE_MAX_WAIT
+
+# The daily quota resets at midnight Pacific time.
+QUOTA_TIMEZONE = ZoneInfo("America/Los_Angeles")
+BUCKET_KEY = "youtube-quota-bucket"
+# Plain integer key so redis_exporter can publish it as a gauge.
+REMAINING_KEY = "youtube-quota-remaining"
+
+# Units per call, from https://developers.google.com/youtube/v3/determine_quota_cost
+COSTS = {
+    "youtube.playlists.list": 1,
+    "youtube.playlistItems.list": 1,
+    "youtube.videos.list": 1,
+    "youtube.search.list": 100,
+}
+
+# Takes `cost` units from today's ledger and the shared token bucket in one
+# step. Returns {1, remaining} on success, {0, seconds to wait} when the
+# bucket is empty and {-1, remaining} when the day's quota is spent.
+RESERVE_SCRIPT = """
+local cost = tonumber(ARGV[1])
+local daily = tonumber(ARGV[2])
+local rate = tonumber(ARGV[3])
+local burst = tonumber(ARGV[4])
+local now = tonumber(ARGV[5])
+
+local used = tonumber(redis.call('GET', KEYS[1]) or '0')
+if used + cost > daily then
+    redis.call('SET', KEYS[3], daily - used)
+    return {-1, daily - used}
+end
+
+local bucket = redis.call('HMGET', KEYS[2], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or burst
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+if tokens < cost then
+    redis.call('HSET', KEYS[2], 'tokens', tokens, 'ts', now)
+    return {0, tostring((cost - tokens) / rate)}
+end
+redis.call('HSET', KEYS[2], 'tokens', tokens - cost, 'ts', now)
+
+used = redis.call('INCRBY', KEYS[1], cost)
+redis.call('EXPIRE', KEYS[1], 2 * 24 * 60 * 60)
+redis.call('SET', KEYS[3], daily - used)
+return {1, daily - used}
+"""
+_reserve = redis_db.register_script(RESERVE_SCRIPT)
+
+
+class QuotaExceeded(Exception):
+    pass
+
+
+def ledger_key():
+    return f"youtube-quota-used-{datetime.now(QUOTA_TIMEZONE).date().isoformat()}"
+
+
+def remaining():
+    return DAILY_QUOTA - int(redis_db.get(ledger_key()) or 0)
+
+
+def is_low():
+    return remaining() < LOW_QUOTA
+
+
+def reserve(method_id):
+    """Take the units for one ``method_id`` call out of the shared budget.
+
+    Waits while the token bucket is empty and raises QuotaExceeded when the
+    day's quota is spent or the wait would exceed MAX_WAIT seconds.
+    """
+    cost = COSTS.get(method_id, 1)
+    deadline = time.monotonic() + MAX_WAIT
+    while True:
+        status, value = _reserve(keys=[ledger_key(), BUCKET_KEY, REMAINING_KEY],
+                                 args=[cost, DAILY_QUOTA, RATE, BURST, time.time()])
+        if status == 1:
+            return int(value)
+        if status == -1:
+            logger.error(f"YouTube quota exhausted, {value} units left for {method_id}")
+            raise QuotaExceeded(f"YouTube API quota exhausted ({value} units left)")
+        wait = float(value)
+        if time.monotonic() + wait > deadline:
+            raise QuotaExceeded(f"Timed out waiting for YouTube API rate limit on {method_id}")
+        time.sleep(wait)
+
+
+class MeteredHttpRequest(HttpRequest):
+    # Every request built by a client using this class is charged to the
+    # ledger before it is sent.
+    def execute(self, http=None, num_retries=0):
+        reserve(self.methodId)
+        return super().execute(http=http, num_retries=num_retries)
@@ -0,0 +1,86 @@
+import hashlib
+import logging
+import re
+from datetime import timedelta
+
+from django.utils import timezone
+
+from PaulStudios import settings
+from songdownloader.models import TrackResolution
+from songdownloader.services.singleflight import SingleFlight
+
+logger = logging.getLogger("Services.Resolver")
+
+RESOLUTION_TTL = timedelta(days=settings.SONGDOWNLOADER_RESOLUTION_TTL_DAYS)
+MISS_TTL = timedelta(hours=settings.SONGDOWNLOADER_RESOLUTION_MISS_TTL_HOURS)
+
+_searches = SingleFlight()
+
+
+def track_key(track_id):
+    return f"spotify:{track_id}"
+
+
+def song_key(title, artists):
+    text = f"{title} - {artists}".lower()
+    text = re.sub(r"[^\w\s-]", "", text)
+    text = re.sub(r"\s+", " ", text).strip()
+    # Hashed so long titles and artist lists still fit the key column.
+    return "song:" + hashlib.sha1(text.encode()).hexdigest()
+
+
+def track_keys(track_id, title, artists):
+    return [track_key(track_id), song_key(title, artists)]
+
+
+def cached_result(cached, keys):
+    # (found, video_id) for the first key present in a lookup_many() result.
+    for key in keys:
+        if key in cached:
+            return True, cached[key]
+    return False, None
+
+
+def lookup_many(keys):
+    """Return ``{key: video_id}`` for every key with an unexpired entry.
+
+    A cached miss maps to ``None``; keys that were never looked up (or
+    whose entry expired) are left out.
+    """
+    rows = TrackResolution.objects.filter(key__in=list(keys), expires__gt=timezone.now())
+    return {row.key: row.youtube_video_id for row in rows}
+
+
+def store_many(results):
+    if not results:
+        return
+    now = timezone.now()
+    rows = [
+        TrackResolution(key=key, youtube_video_id=video_id,
+                        expires=now + (RESOLUTION_TTL if video_id else MISS_TTL))
+        for key, video_id in results.items()
+    ]
+    TrackResolution.objects.bulk_create(rows, update_conflicts=True, unique_fields=["key"],
+                                        update_fields=["youtube_video_id", "expires"])
+
+
+def search_once(key, search):
+    # Concurrent lookups for the same key in this process share one search.
+    return _searches.run(key, search)
+
+
+def resolve(track_id, title, artists, search):
+    """Return the YouTube video id for a Spotify track, or ``None``.
+
+    ``search`` is only called when neither the track id nor the normalized
+    title and artists have an unexpired entry.
+    """
+    keys = track_keys(track_id, title, artists)
+    found, video_id = cached_result(lookup_many(keys), keys)
+    if found:
+        return video_id
+    video_id = search_once(keys[0], search)
+    if not video_id:
+        logger.info(f"No YouTube match for {title} [{artists}]")
+    store_many(dict.fromkeys(keys, video_id))
+    return video_id
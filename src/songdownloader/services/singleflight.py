@@ -0,0 +1,33 @@
+import threading
+from concurrent.futures import Future
+
+
+class SingleFlight:
+    """Collapses concurrent calls for the same key in this process into one.
+
+    The first caller for a key runs the call; callers arriving while it
+    runs wait for it and get the same result or exception.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def run(self, key, fn):
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+        if not leader:
+            return future.result()
+        try:
+            result = fn()
+            future.set_result(result)
+            return result
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
@@ -1,18 +1,25 @@
 import base64
-import concurrent
+import json
 import logging
 import os
 import tempfile
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
+import redis
 import requests
 from django.core.files import File
 from lyrics_extractor import SongLyrics
+from requests.adapters import HTTPAdapter
 from youtube_search import YoutubeSearch
 
 from PaulStudios import settings
 from base.tasks import increase_progress, update_progress
-from songdownloader.models import SpotifyPlaylist, SpotifySong
-from songdownloader.services.downloader import process_image
+from songdownloader.models import SpotifyPlaylist, SpotifyPlaylistTrack, SpotifySong
+from songdownloader.services import resolver
+from songdownloader.services.downloader import run_bounded
+from songdownloader.services.images import process_image
 
 # Replace these with your own Spotify credentials
 CLIENT_ID = settings.SONGDOWNLOADER_SPOTIFY_CLIENT_ID
@@ -21,6 +28,22 @@ GCS_API_KEY = settings.GCS_API_KEY
 GCS_ENGINE_ID = settings.GCS_ENGINE_ID
 
 logger = logging.getLogger("Services.Spotify")
+redis_db = redis.from_url(settings.REDIS_URL, decode_responses=True)
+
+TOKEN_KEY = "spotify-access-token"
+# Refresh this many seconds before Spotify says the token expires.
+TOKEN_REFRESH_MARGIN = 5 * 60
+METADATA_TTL = settings.SONGDOWNLOADER_SPOTIFY_METADATA_TTL
+TRACK_ITEM_FIELDS = "items(track(id,name,artists(name),album(images)))"
+PLAYLIST_FIELDS = f"name,snapshot_id,images,tracks(total,{TRACK_ITEM_FIELDS})"
+PAGE_SIZE = 100
+PAGE_WORKERS = 8
+MAX_PAGE_RETRIES = 3
+
+SpotifyTrackItem = namedtuple("SpotifyTrackItem", ["id", "name", "artists", "image"])
+
+http = requests.Session()
+http.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=PAGE_WORKERS))
 
 
 def get_track_details(track):
@@ -34,6 +57,56 @@ def get_track_details(track):
         logger.warning(e)
 
 
+def get_document(path, access_token, params=None):
+    # Metadata documents are cached in Redis for a short while so that jobs
+    # for the same playlist or track share one request.
+    url = f"https://api.spotify.com/v1/{path}"
+    key = f"spotify-document-{path}-{json.dumps(params, sort_keys=True)}"
+    if METADATA_TTL:
+        cached = redis_db.get(key)
+        if cached:
+            return json.loads(cached)
+    headers = {
+        'Authorization': f'Bearer {access_token}'
+    }
+    response = requests.get(url, headers=headers, params=params)
+    data = response.json()
+    if METADATA_TTL and response.ok:
+        redis_db.set(key, json.dumps(data), ex=METADATA_TTL)
+    return data
+
+
+def get_access_token():
+    # One client-credentials token is shared by every web and Celery process
+    # through Redis. Only one of them refreshes it at a time.
+    token = redis_db.get(TOKEN_KEY)
+    if token:
+        return token
+    with redis_db.lock(f"{TOKEN_KEY}-lock", timeout=30, blocking_timeout=30):
+        token = redis_db.get(TOKEN_KEY)
+        if token:
+            return token
+        auth_url = 'https://accounts.spotify.com/api/token'
+        auth_headers = {
+            'Authorization': 'Basic ' + base64.b64encode(f"{CLIENT_ID}:{CLIENT_SECRET}".encode()).decode()
+        }
+        auth_data = {
+            'grant_type': 'client_credentials'
+        }
+        response = requests.post(auth_url, headers=auth_headers, data=auth_data)
+        response_data = response.json()
+        expires_in = int(response_data.get('expires_in', 3600))
+        redis_db.set(TOKEN_KEY, response_data['access_token'], ex=max(expires_in - TOKEN_REFRESH_MARGIN, 1))
+        return response_data['access_token']
+
+
+def compact_track(track):
+    details = get_track_details(track)
+    if details:
+        track_id, track_name, album_image, artists = details
+        return SpotifyTrackItem(track_id, track_name, artists, album_image)
+
+
 def parse_songs(track, counter, total_tracks):
     try:
         track_id, track_name, album_image, artists = get_track_details(track['track'])
@@ -60,7 +133,7 @@ class Spotify:
         self.id = self.parse_id(url)
         self.client_id = CLIENT_ID
         self.client_secret = CLIENT_SECRET
-        self.access_token = self._get_access_token()
+        self.access_token = get_access_token()
         self._extract_lyrics = SongLyrics(GCS_API_KEY, GCS_ENGINE_ID)
         if mode == 'Playlist':
             self.data = self._SpotifyPlaylist(self.id, self.access_token)
@@ -74,18 +147,6 @@ class Spotify:
         except AttributeError as e:
             return id.split("/")[-1]
 
-    def _get_access_token(self):
-        auth_url = 'https://accounts.spotify.com/api/token'
-        auth_headers = {
-            'Authorization': 'Basic ' + base64.b64encode(f"{self.client_id}:{self.client_secret}".encode()).decode()
-        }
-        auth_data = {
-            'grant_type': 'client_credentials'
-        }
-        response = requests.post(auth_url, headers=auth_headers, data=auth_data)
-        response_data = response.json()
-        return response_data['access_token']
-
     def _get_lyrics(self, track_name):
         return self._extract_lyrics.get_lyrics(track_name)
 
@@ -94,18 +155,18 @@ class Spotify:
             logger.info('Track mode selected')
             self.track_id = id
             self.access_token = token
+            self._data = None
 
-        def get_track_data(self, playlist_id: str):
-            playlist_url = f"https://api.spotify.com/v1/tracks/{playlist_id}"
-            headers = {
-                'Authorization': f'Bearer {self.access_token}'
-            }
-            response = requests.get(playlist_url, headers=headers)
-            return response.json()
+        def get_track_data(self, playlist_id: str = None):
+            if playlist_id not in (None, self.track_id):
+                return get_document(f"tracks/{playlist_id}", self.access_token)
+            if self._data is None:
+                self._data = get_document(f"tracks/{self.track_id}", self.access_token)
+            return self._data
 
         @property
         def name(self) -> str:
-            return self.get_track_data(self.track_id)['name']
+            return self.get_track_data()['name']
 
     class _SpotifyPlaylist:
         def __init__(self, id: str, token: str):
@@ -113,49 +174,60 @@ class Spotify:
             self.playlist_id = id
             self.access_token = token
             self.track_list = []
+            self._data = None
+
+        @property
+        def data(self):
+            # The playlist document with the first page of tracks, fetched once.
+            if self._data is None:
+                self._data = get_document(f"playlists/{self.playlist_id}", self.access_token,
+                                          {"fields": PLAYLIST_FIELDS})
+            return self._data
 
         def get_tracks_list(self):
             logger.info('Getting list of tracks')
-            playlist_url = f"https://api.spotify.com/v1/playlists/{self.playlist_id}/tracks"
+            first_page = self.data['tracks']
+            # The first page says how many tracks there are, so the remaining
+            # pages can be fetched side by side instead of following `next`.
+            offsets = range(len(first_page['items']), first_page['total'], PAGE_SIZE)
+            pages = [first_page['items']]
+            with ThreadPoolExecutor(max_workers=PAGE_WORKERS) as executor:
+                pages.extend(executor.map(self._get_page, offsets))
+            seen = set()
+            for items in pages:
+                for item in items:
+                    track = compact_track(item.get('track'))
+                    if track is None or not track.id or not track.name or track.id in seen:
+                        continue
+                    seen.add(track.id)
+                    self.track_list.append(track)
+            return None
+
+        def _get_page(self, offset):
+            url = f"https://api.spotify.com/v1/playlists/{self.playlist_id}/tracks"
             headers = {
                 'Authorization': f'Bearer {self.access_token}'
             }
-            response = requests.get(playlist_url, headers=headers)
-            res = response.json()
-            items = res['items']
-            # if res['next'] is None: return items
-            while res['next']:
-                response = requests.get(res['next'], headers=headers)
-                res = response.json()
-                items.extend(res['items'])
-            res = [i for n, i in enumerate(items) if i not in items[:n]]
-            for item in res:
-                try:
-                    if not item['track']['name'] == "":
-                        self.track_list.append(item)
-                except Exception as e:
-                    print(e)
-            return None
+            params = {"offset": offset, "limit": PAGE_SIZE, "fields": TRACK_ITEM_FIELDS}
+            for attempt in range(MAX_PAGE_RETRIES):
+                response = http.get(url, headers=headers, params=params)
+                if response.status_code != 429:
+                    break
+                time.sleep(int(response.headers.get('Retry-After', 1)))
+            response.raise_for_status()
+            return response.json()['items']
 
         @property
         def name(self):
-            playlist_url = f"https://api.spotify.com/v1/playlists/{self.playlist_id}"
-            headers = {
-                'Authorization': f'Bearer {self.access_token}'
-            }
-            response = requests.get(playlist_url, headers=headers)
-            return response.json()['name']
+            return self.data['name']
 
         @property
         def image(self):
-            playlist_url = f"https://api.spotify.com/v1/playlists/{self.playlist_id}/images"
-            headers = {
-                'Authorization': f'Bearer {self.access_token}'
-            }
-            response = requests.get(playlist_url, headers=headers)
-            image_url = response.json()[0]['url']
+            return self.data['images'][0]['url']
 
-            return image_url
+        @property
+        def snapshot_id(self):
+            return self.data['snapshot_id']
 
 
 def search_song(song_name):
@@ -168,29 +240,136 @@ def search_song(song_name):
         return None
 
 
-def make_playlist(playlist_id, playlist_data, song_list, task_id):
-    song_objects = []
+def resolve_songs(song_list, playlist_name, task_id, on_track=None):
+    """Resolve ``song_list`` and return ``{number: song}``.
+
+    Tracks that could not be resolved, or repeat an earlier song, get no
+    number, so the numbers stay contiguous. Songs are handed to
+    ``on_track`` in playlist order as soon as every track before them has
+    been resolved.
+    """
     total_tracks = len(song_list)
+    songs = {}
+    resolved = {}
+    seen = set()
+    next_counter = 1
+
+    def release():
+        nonlocal next_counter
+        while next_counter in resolved:
+            song = resolved.pop(next_counter)
+            next_counter += 1
+            if song is None or song.id in seen:
+                continue
+            seen.add(song.id)
+            number = len(songs) + 1
+            songs[number] = song
+            if on_track:
+                on_track(number, song)
+
+    # Known songs come from one query; only new ones go to the network pool.
+    existing = SpotifySong.objects.in_bulk([track.id for track in song_list])
+    new_tracks = []
+    for counter, track in enumerate(song_list, 1):
+        song = existing.get(track.id)
+        if song is None:
+            new_tracks.append((counter, track))
+            continue
+        logger.info(f"Parsing track: {song.name} ({counter}/{total_tracks}) [{playlist_name}]")
+        update_progress(song.name, task_id, song.image.url)
+        resolved[counter] = song
+    release()
+
+    cached = resolver.lookup_many(key for _, track in new_tracks
+                                  for key in resolver.track_keys(track.id, track.name, track.artists))
+    resolutions = {}
+    created = []
+    args = ((track, counter, total_tracks, playlist_name, task_id, cached, resolutions)
+            for counter, track in new_tracks)
+    for position, song in run_bounded(resolve_track, args):
+        resolved[new_tracks[position - 1][0]] = song
+        if song:
+            created.append(song)
+        release()
+
+    resolver.store_many(resolutions)
+    SpotifySong.objects.bulk_create(created, ignore_conflicts=True)
+    return songs
+
+
+def make_playlist(playlist_id, playlist_data, song_list, task_id, on_track=None):
+    songs = resolve_songs(song_list, playlist_data.name, task_id, on_track)
 
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        futures = [executor.submit(process_track, track['track'], counter, total_tracks, playlist_data.name, task_id)
-                   for counter, track in enumerate(song_list, 1)]
-        for future in concurrent.futures.as_completed(futures):
-            if future.result():
-                song_objects.append(future.result())
     logger.info(f"Creating Playlist: {playlist_data.name}")
     increase_progress(task_id)
     playlist = SpotifyPlaylist.objects.create(
         id=playlist_id,
         name=playlist_data.name,
+        snapshot_id=playlist_data.snapshot_id,
     )
     process_image(playlist, playlist_data.image)
-    playlist.tracks.set(song_objects)
+    save_positions(playlist, songs)
+
+
+def save_positions(playlist, songs):
+    # Upsert on (playlist, song) so a track that moved keeps its row and
+    # only gets its new position.
+    SpotifyPlaylistTrack.objects.bulk_create(
+        [SpotifyPlaylistTrack(playlist_id=playlist.id, song_id=song.id, position=counter)
+         for counter, song in songs.items()],
+        update_conflicts=True, unique_fields=["playlist", "song"], update_fields=["position"],
+    )
+
+
+def sync_playlist(playlist, playlist_data, song_list, task_id, on_track=None):
+    # Only the tracks that were added or removed since the stored snapshot
+    # are written; songs already in the database are not resolved again.
+    songs = resolve_songs(song_list, playlist_data.name, task_id, on_track)
+
+    logger.info(f"Updating Playlist: {playlist_data.name}")
+    increase_progress(task_id)
+    wanted = {song.id for song in songs.values()}
+    playlist.entries.exclude(song_id__in=wanted).delete()
+    save_positions(playlist, songs)
+    playlist.name = playlist_data.name
+    playlist.snapshot_id = playlist_data.snapshot_id
+    playlist.save(update_fields=["name", "snapshot_id"])
+
+
+def resolve_track(track, counter, total_tracks, playlist_name, task_id, cached, resolutions):
+    # Runs on the resolution pool: network only, the caller does the writes.
+    try:
+        track_id, track_name, artists, album_image = track
+        logger.info(f"Parsing track: {track_name} ({counter}/{total_tracks}) [{playlist_name}]")
+        name = track_name
+        if len(track_name) > 40:
+            name = track_name[:40]
+        keys = resolver.track_keys(track_id, track_name, artists)
+        found, video_id = resolver.cached_result(cached, keys)
+        if not found:
+            video_id = resolver.search_once(keys[0], lambda: search_song(f"{name}"))
+            resolutions.update(dict.fromkeys(keys, video_id))
+        if not video_id:
+            increase_progress(task_id)
+            return None
+        song = SpotifySong(
+            id=track_id,
+            name=track_name,
+            artists=artists,
+            youtube_video_id=video_id
+        )
+        process_image(song, album_image, save=False)
+        update_progress(song.name, task_id, song.image.url)
+        return song
+    except Exception as e:
+        logger.error(e)
+        increase_progress(task_id)
+        return
 
 
 def process_track(track, counter, total_tracks, playlist_name, task_id):
     try:
-        track_id, track_name, album_image, artists = get_track_details(track)
+        track_id, track_name, artists, album_image = track
         logger.info(f"Parsing track: {track_name} ({counter}/{total_tracks}) [{playlist_name}]")
         name = track_name
         if len(track_name) > 40:
@@ -198,9 +377,9 @@ def process_track(track, counter, total_tracks, playlist_name, task_id):
         if SpotifySong.objects.filter(id=track_id).exists():
             song = SpotifySong.objects.get(id=track_id)
         else:
-            x = search_song(f"{name}")
+            x = resolver.resolve(track_id, track_name, artists, lambda: search_song(f"{name}"))
             if not x:
-                return "None"
+                return None
             song = SpotifySong.objects.create(
                 id=track_id,
                 name=track_name,
@@ -0,0 +1,89 @@
+import logging
+import mmap
+import os
+import threading
+
+import requests
+
+logger = logging.getLogger("Services.WordList")
+
+# Bump the version whenever SOURCES or the normalisation in build() change,
+# so a stale file is never picked up by new code.
+WORDLIST_VERSION = 1
+WORDLIST_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), "data",
+                             f"english-words-v{WORDLIST_VERSION}.txt")
+
+SOURCES = [
+    'https://raw.githubusercontent.com/dolph/dictionary/master/enable1.txt',
+    'https://raw.githubusercontent.com/wordnik/wordlist/main/wordlist-20210729.txt',
+    'https://raw.githubusercontent.com/dwyl/english-words/master/words.txt',
+    'https://raw.githubusercontent.com/first20hours/google-10000-english/master/google-10000-english.txt',
+    'https://raw.githubusercontent.com/sindresorhus/word-list/main/words.txt',
+]
+
+
+def build(path=WORDLIST_PATH, sources=SOURCES):
+    """Download ``sources`` and write them to ``path`` as one sorted,
+    de-duplicated, lower-case word per line. Returns the number of words."""
+    words = set()
+    for url in sources:
+        response = requests.get(url, timeout=60)
+        if response.status_code != 200:
+            logger.error(f"Error getting word list from {url}")
+            raise Exception("Error getting word list")
+        words.update(line.strip().strip('"').lower() for line in response.text.split('\n'))
+    words.discard("")
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, "wb") as fh:
+        fh.write(b"\n".join(sorted(word.encode() for word in words)))
+    os.replace(temp_path, path)
+    return len(words)
+
+
+class WordList:
+    """Read-only view of a file written by :func:`build`.
+
+    The file is mapped on the first lookup and searched in place, so forked
+    workers share the same pages instead of each holding its own copy.
+    """
+
+    def __init__(self, path=WORDLIST_PATH):
+        self.path = path
+        self._data = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        with self._lock:
+            if self._data is None:
+                try:
+                    with open(self.path, "rb") as fh:
+                        self._data = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+                except (OSError, ValueError) as e:
+                    logger.warning(f"Word list {self.path} is not available ({e}), "
+                                   f"run `manage.py build_wordlist` to create it")
+                    self._data = b""
+        return self._data
+
+    def lookup(self, word):
+        data = self._data if self._data is not None else self._load()
+        key = word.encode()
+        lo, hi = 0, len(data)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = data.rfind(b"\n", 0, mid) + 1
+            end = data.find(b"\n", start)
+            if end == -1:
+                end = len(data)
+            line = data[start:end]
+            if line == key:
+                return True
+            if line < key:
+                lo = end + 1
+            else:
+                hi = start
+        return False
+
+
+english_words = WordList()
@@ -1,107 +1,83 @@
+import json
 import logging
-import re
-from concurrent.futures import ThreadPoolExecutor, as_completed
-
-import pandas as pd
-import requests
-from googleapiclient.discovery import build
+import math
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from celery.signals import worker_process_shutdown
+from googleapiclient import discovery_cache
+from googleapiclient.discovery import build_from_document
+from googleapiclient.http import build_http
 from lyrics_extractor import SongLyrics
 
 from PaulStudios import settings
 from base.tasks import increase_progress, update_progress
-from songdownloader.models import YouTubeSong, YouTubePlaylist
-from songdownloader.services.downloader import process_image
+from songdownloader.models import YouTubeSong, YouTubePlaylist, YouTubePlaylistTrack
+from songdownloader.services import quota
+from songdownloader.services.artists import extract_artist, extract_artists
+from songdownloader.services.downloader import run_bounded
+from songdownloader.services.images import process_image
 
 logger = logging.getLogger("Services.Youtube")
 GCS_API_KEY = settings.GCS_API_KEY
 GCS_ENGINE_ID = settings.GCS_ENGINE_ID
 api_key = settings.YT_API_KEY
 
-
-class HashTable:
-    def __init__(self):
-        self.table = {}
-
-    def insert(self, word):
-        self.table[word] = True
-
-    def lookup(self, word):
-        return word in self.table
-
-
-word_list = HashTable()
-
-
-def set_word_list():
-    r1 = requests.get('https://raw.githubusercontent.com/dolph/dictionary/master/enable1.txt')
-    r2 = requests.get('https://raw.githubusercontent.com/wordnik/wordlist/main/wordlist-20210729.txt')
-    r3 = requests.get('https://raw.githubusercontent.com/dwyl/english-words/master/words.txt')
-    r4 = requests.get(
-        'https://raw.githubusercontent.com/first20hours/google-10000-english/master/google-10000-english.txt')
-    r5 = requests.get('https://raw.githubusercontent.com/sindresorhus/word-list/main/words.txt')
-    if r1.status_code != 200 or r2.status_code != 200 or r3.status_code != 200 or r4.status_code != 200 or r5.status_code != 200:
-        logger.error("Error getting word list")
-        raise Exception("Error getting word list")
-    text = r1.text + r2.text + r3.text + r4.text + r5.text
-    words_array = text.split('\n')
-    for word in words_array:
-        word_list.insert(word)
-
-
-def _extract_artist(title, description, tags):
-    # Extract artist from description first
-    description_patterns = [
-        r"artist: (.+)",  # Look for "Artist: Artist Name"
-        r"singer: (.+)",  # Look for "Singer: Artist1, Artist2"
-        r"singer : (.+)",  # Look for "SINGER : Artist Name"
-        r"singer - (.+)",  # Look for "SINGER - Artist Name"
-        r"music: (.+)",  # Look for "MUSIC: Artist Name"
-        r"music : (.+)",  # Look for "Music : Artist Name"
-        r"by (.+)",  # Look for "by Artist" in description
-    ]
-
-    description_lines = description.split('\n')
-    for line in description_lines:
-        for pattern in description_patterns:
-            match = re.search(pattern, line, re.IGNORECASE)
-            if match:
-                artist_name = match.group(1).strip()
-                for word in artist_name.split(' '):
-                    if word_list.lookup(word.lower()):
-                        return "Unknown"      # Return None if artist name is a common English word
-                    return artist_name
-
-    # Attempt to extract artist from the title using various patterns
-    title_patterns = [
-        r"(.+) \| (.+)$",  # Pattern like 'Title | Artist'
-        r"(.+) \| (.+) \| (.+)",  # Pattern like 'Title | Artist1 | Artist2'
-        r"(.+) \| (.+) \| t-series",  # Pattern like 'Title | Artist | T-Series'
-        r"\"(.+)\" by (.+)",  # Pattern like '"Song" by Artist'
-        r"(.+): (.+)",  # Pattern like 'Artist: Title'
-        r" - (.+)$",  # Common pattern "Title - Artist"
-        r"(.+) - topic",  # YouTube's autogenerated format 'Artist - Topic'
-        r"(.+) - topic",  # YouTube's autogenerated format 'Artist - Topic'
-    ]
-
-    for pattern in title_patterns:
-        match = re.search(pattern, title, re.IGNORECASE)
-        if match:
-            artist_name = match.group(2).strip() if len(match.groups()) == 2 else match.group(1).strip()
-            for word in artist_name.split(' '):
-                if word_list.lookup(word.lower()):
-                    return "Unknown"  # Return None if artist name is a common English word
-                return artist_name
-
-        # Use tags if available
-    for tag in tags:
-        if "artist" in tag.lower():
-            artist_name = tag.strip()
-            for word in artist_name.split(' '):
-                if word_list.lookup(word.lower()):
-                    return "Unknown"  # Return None if artist name is a common English word
-                return artist_name
-
-    return "Unknown"  # Return None if artist name extraction fails
+PAGE_SIZE = 50
+# Playlists being listed at the same time in one worker process.
+PREFETCH_WORKERS = 2
+# Titles playlistItems gives videos that can no longer be played.
+UNAVAILABLE_TITLES = {"Private video", "Deleted video"}
+
+YoutubeVideo = namedtuple("YoutubeVideo", ["id", "title", "artist", "thumbnail", "url"])
+
+_discovery_document = None
+_discovery_lock = threading.Lock()
+_clients = threading.local()
+
+_prefetch_executor = None
+_prefetch_lock = threading.Lock()
+
+
+def get_client():
+    """YouTube Data API client for the calling thread.
+
+    The discovery document bundled with googleapiclient is parsed once per
+    process. Each thread then builds its own client on its own connection,
+    since the underlying httplib2 transport is not thread-safe. Every request
+    is charged to the shared quota ledger.
+    """
+    global _discovery_document
+    client = getattr(_clients, "youtube", None)
+    if client is None:
+        with _discovery_lock:
+            if _discovery_document is None:
+                _discovery_document = json.loads(discovery_cache.get_static_doc('youtube', 'v3'))
+        client = _clients.youtube = build_from_document(_discovery_document, developerKey=api_key,
+                                                        http=build_http(),
+                                                        requestBuilder=quota.MeteredHttpRequest)
+    return client
+
+
+def get_prefetch_executor():
+    # Kept apart from the download pool, where a page request would wait
+    # behind whole track downloads of other jobs.
+    global _prefetch_executor
+    with _prefetch_lock:
+        if _prefetch_executor is None:
+            _prefetch_executor = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS,
+                                                    thread_name_prefix="youtube-prefetch")
+    return _prefetch_executor
+
+
+@worker_process_shutdown.connect
+def shutdown_prefetch_executor(**kwargs):
+    global _prefetch_executor
+    with _prefetch_lock:
+        if _prefetch_executor is not None:
+            _prefetch_executor.shutdown(wait=False, cancel_futures=True)
+            _prefetch_executor = None
 
 
 def _get_thumbnail_url(thumbnails):
@@ -148,18 +124,19 @@ class Youtube:
             self.playlist_id = playlist_id
             self._playlist_title = None
             self._playlist_thumbnail = None
-            self.dataset = pd.DataFrame()
+            self.track_list = []
             self.snippet = dict()
+            self.content_details = dict()
             self._api_key = api_key
-            self._api_client = build('youtube', 'v3', developerKey=self._api_key)
+            self._api_client = get_client()
 
         def get_playlist_details(self):
-            # Build the YouTube service
-            youtube = self._api_client
-
-            # Get playlist details
-            playlist_request = youtube.playlists().list(
-                part='snippet',
+            # Snippet and item count come from the same call, so it is made
+            # once per playlist.
+            if self.snippet:
+                return
+            playlist_request = self._api_client.playlists().list(
+                part='snippet,contentDetails',
                 id=self.playlist_id
             )
             playlist_response = playlist_request.execute()
@@ -168,88 +145,94 @@ class Youtube:
                 raise ValueError("Invalid playlist ID or no items found in the playlist")
 
             self.snippet = playlist_response['items'][0]['snippet']
+            self.content_details = playlist_response['items'][0]['contentDetails']
 
         @property
         def name(self):
-            snippet = self.snippet
-            playlist_title = snippet['title']
-            return playlist_title
+            self.get_playlist_details()
+            return self.snippet['title']
 
         @property
         def image(self):
-            snippet = self.snippet
-            playlist_thumbnails = snippet['thumbnails']
-            playlist_thumbnail = (
-                    playlist_thumbnails.get('high') or
-                    playlist_thumbnails.get('medium') or
-                    playlist_thumbnails.get('default')
-            )['url']
-            return playlist_thumbnail
+            self.get_playlist_details()
+            return _get_thumbnail_url(self.snippet['thumbnails'])
 
         @property
         def num_of_tracks(self):
-            youtube = self._api_client
+            self.get_playlist_details()
+            return self.content_details['itemCount']
 
-            # Get playlist details
-            playlist_request = youtube.playlists().list(
-                part='contentDetails',
-                id=self.playlist_id,
+        def _get_page(self, page_token):
+            # Runs on the prefetch thread as well, so it uses that thread's client.
+            request = get_client().playlistItems().list(
+                part='snippet,contentDetails',
+                playlistId=self.playlist_id,
+                maxResults=PAGE_SIZE,
+                pageToken=page_token
             )
-            playlist_response = playlist_request.execute()
-            n = playlist_response['items'][0]['contentDetails']['itemCount']
+            return request.execute()
 
-            return n
+        def _get_video_snippets(self, video_ids):
+            # One call for the whole page instead of one per video.
+            request = self._api_client.videos().list(
+                part='snippet',
+                id=','.join(video_ids),
+                maxResults=PAGE_SIZE
+            )
+            response = request.execute()
+            return {item['id']: item['snippet'] for item in response['items']}
 
         def get_videos(self, task_id):
-            youtube = self._api_client
-            videos = []
-            next_page_token = None
-
-            while True:
-                playlist_items_request = youtube.playlistItems().list(
-                    part='snippet,contentDetails',
-                    playlistId=self.playlist_id,
-                    maxResults=50,
-                    pageToken=next_page_token
-                )
-                playlist_items_response = playlist_items_request.execute()
-
-                if not playlist_items_response['items']:
-                    break
-
-                for item in playlist_items_response['items']:
-                    video_title = item['snippet']['title']
+            # Every page costs a listing call and a details call; stop now
+            # instead of running out halfway through.
+            pages = math.ceil(self.content_details.get('itemCount', 0) / PAGE_SIZE)
+            cost = pages * (quota.COSTS["youtube.playlistItems.list"] + quota.COSTS["youtube.videos.list"])
+            if quota.remaining() < cost:
+                raise quota.QuotaExceeded(f"Not enough YouTube API quota left to list {self.playlist_id}")
+
+            seen = set()
+            # The next page is requested while the current one is parsed.
+            page = self._get_page(None)
+            while page['items']:
+                next_page_token = page.get('nextPageToken')
+                next_page = None
+                if next_page_token:
+                    next_page = get_prefetch_executor().submit(self._get_page, next_page_token)
+
+                # Private and deleted videos stay in the playlist as placeholders.
+                available = [item for item in page['items'] if item['snippet']['title'] not in UNAVAILABLE_TITLES]
+                video_ids = [item['contentDetails']['videoId'] for item in available]
+                if quota.is_low():
+                    # Artists come from the titles alone, which saves the
+                    # description lookup.
+                    logger.warning(f"YouTube quota is low, skipping descriptions for {self.playlist_id}")
+                    snippets = {video_id: {'description': ""} for video_id in video_ids}
+                elif video_ids:
+                    snippets = self._get_video_snippets(video_ids)
+                else:
+                    snippets = {}
+                # Private and deleted videos are left out of the response
+                items = [(item, snippets[item['contentDetails']['videoId']]) for item in available
+                         if item['contentDetails']['videoId'] in snippets]
+                artists = extract_artists((item['snippet']['title'], snippet['description'], snippet.get('tags', []))
+                                          for item, snippet in items)
+                for (item, _), artist in zip(items, artists):
+                    increase_progress(task_id)
                     video_id = item['contentDetails']['videoId']
-                    video_thumbnail = _get_thumbnail_url(item['snippet'].get('thumbnails'))
-                    video_url = f"https://www.youtube.com/watch?v={video_id}"
-
-                    video_request = youtube.videos().list(
-                        part='snippet',
-                        id=video_id
-                    )
-                    video_response = video_request.execute()
-
-                    # Check if the video response contains items
-                    if not video_response['items']:
+                    if video_id in seen:
                         continue
-
-                    video_description = video_response['items'][0]['snippet']['description']
-                    video_tags = video_response['items'][0]['snippet'].get('tags', [])
-
-                    artist = _extract_artist(video_title, video_description, video_tags)
-
-                    videos.append((video_title, artist, video_thumbnail, video_url))
-                    increase_progress(task_id)
-                    print(video_title)
-
-
-                next_page_token = playlist_items_response.get('nextPageToken')
-
-                print(next_page_token)
-                if not next_page_token:
+                    seen.add(video_id)
+                    self.track_list.append(YoutubeVideo(
+                        id=video_id,
+                        title=item['snippet']['title'],
+                        artist=artist,
+                        thumbnail=_get_thumbnail_url(item['snippet'].get('thumbnails')),
+                        url=f"https://www.youtube.com/watch?v={video_id}",
+                    ))
+
+                if next_page is None:
                     break
-
-            self.dataset = pd.DataFrame(videos, columns=['Song Title', 'Artists', 'Thumbnail', 'URL'])
+                page = next_page.result()
 
     class YoutubeTrack:
         def __init__(self, track_id, api_key):
@@ -257,45 +240,44 @@ class Youtube:
             self.name = ""
             self.artist = ""
             self.thumbnail = ""
-            self.snippet = dict()
+            self._details = None
             self._api_key = api_key
-            self._api_client = build('youtube', 'v3', developerKey=self._api_key)
+            self._api_client = get_client()
 
-        def get_video_details(self):
-            youtube = self._api_client
-
-            request = youtube.videos().list(
-                part='snippet',
-                id=self.video_id
-            )
-            response = request.execute()
-            if response['items']:
-                video_info = response['items'][0]['snippet']
-                self.name = video_info['title']
-                self.thumbnail = _get_thumbnail_url(video_info['thumbnails'])
-                return {
-                    'title': video_info['title'],
-                    'thumbnail': _get_thumbnail_url(video_info['thumbnails'])
-                }
-            else:
-                return None
+        def _get_details(self):
+            # Every property of the track comes from this one call.
+            if self._details is None:
+                request = self._api_client.videos().list(
+                    part='snippet,contentDetails',
+                    id=self.video_id
+                )
+                response = request.execute()
+                self._details = response['items'][0] if response['items'] else {}
+            return self._details
 
-        def get_artists(self):
-            youtube = self._api_client
+        @property
+        def description(self):
+            return self._get_details().get('snippet', {}).get('description', "")
 
-            request = youtube.videos().list(
-                part='snippet,contentDetails',
-                id=self.video_id
-            )
-            response = request.execute()
-            if response['items']:
-                video_info = response['items'][0]['snippet']
-                video_description = response['items'][0]['snippet']['description']
-                video_tags = response['items'][0]['snippet'].get('tags', [])
-                video_url = f"https://www.youtube.com/watch?v={self.video_id}"
+        @property
+        def tags(self):
+            return self._get_details().get('snippet', {}).get('tags', [])
 
-                self.artist = _extract_artist(self.name, video_description, video_tags)
+        def get_video_details(self):
+            details = self._get_details()
+            if not details:
+                return None
+            video_info = details['snippet']
+            self.name = video_info['title']
+            self.thumbnail = _get_thumbnail_url(video_info['thumbnails'])
+            return {
+                'title': self.name,
+                'thumbnail': self.thumbnail
+            }
 
+        def get_artists(self):
+            if self._get_details():
+                self.artist = extract_artist(self.name, self.description, self.tags)
 
 
 def parse_video_id(url):
@@ -305,21 +287,16 @@ def parse_video_id(url):
         return url.split("v=")[-1]
 
 
-def process_track(title, artists, thumbnail, url, counter, total, playlist_name, task_id):
+def fetch_track(video, counter, total, playlist_name, task_id):
+    # Runs on the thumbnail pool: network and storage only, no queries.
     try:
-        track_id = parse_video_id(url)
-        track_name = title
-        artists = artists
-        logger.info(f"Parsing track: {track_name} ({counter}/{total}) [{playlist_name}]")
-        if YouTubeSong.objects.filter(id=track_id).exists():
-            song = YouTubeSong.objects.get(id=track_id)
-        else:
-            song = YouTubeSong.objects.create(
-                id=track_id,
-                name=track_name,
-                artists=artists,
-            )
-            process_image(song, thumbnail)
+        logger.info(f"Parsing track: {video.title} ({counter}/{total}) [{playlist_name}]")
+        song = YouTubeSong(
+            id=video.id,
+            name=video.title,
+            artists=video.artist,
+        )
+        process_image(song, video.thumbnail, save=False)
         update_progress(song.name, task_id, song.image.url)
         return song
     except Exception as e:
@@ -328,30 +305,37 @@ def process_track(title, artists, thumbnail, url, counter, total, playlist_name,
         return
 
 
-def make_playlist(playlist_id, playlist_name, playlist_thumbnail, song_dataset, total_tracks, task_id):
-    song_objects = []
-
-    title = song_dataset["Song Title"]
-    artists = song_dataset["Artists"]
-    thumbnail = song_dataset["Thumbnail"]
-    url = song_dataset["URL"]
-
-    with ThreadPoolExecutor() as executor:
-        tasks = []
-        for counter, song in enumerate(range(total_tracks), 0):
-            try:
-                tasks.append(
-                    executor.submit(process_track, title[counter],
-                                    artists[counter], thumbnail[counter],
-                                    url[counter], counter + 1,
-                                    total_tracks, playlist_name,
-                                    task_id))
-            except KeyError as e:
-                print(f"Failed Track: {e}")
-                increase_progress(task_id)
-        for task in as_completed(tasks):
-            if task.result():
-                song_objects.append(task.result())
+def make_playlist(playlist_id, playlist_name, playlist_thumbnail, video_list, total_tracks, task_id, on_track=None):
+    songs = {}
+
+    # Private, deleted and repeated videos are not in video_list, but the
+    # progress total was counted from the playlist's item count.
+    for _ in range(total_tracks - len(video_list)):
+        increase_progress(task_id)
+
+    # Known songs come from one query; only new ones need their thumbnail.
+    existing = YouTubeSong.objects.in_bulk([video.id for video in video_list])
+    new_tracks = []
+    for counter, video in enumerate(video_list, 1):
+        song = existing.get(video.id)
+        if song is None:
+            new_tracks.append((video, counter, total_tracks, playlist_name, task_id))
+            continue
+        logger.info(f"Parsing track: {song.name} ({counter}/{total_tracks}) [{playlist_name}]")
+        update_progress(song.name, task_id, song.image.url)
+        songs[counter] = song
+        if on_track:
+            on_track(counter, song)
+
+    for position, song in run_bounded(fetch_track, new_tracks):
+        if song:
+            counter = new_tracks[position - 1][1]
+            songs[counter] = song
+            if on_track:
+                on_track(counter, song)
+
+    YouTubeSong.objects.bulk_create([songs[track[1]] for track in new_tracks if track[1] in songs],
+                                    ignore_conflicts=True)
 
     logger.info(f"Creating Playlist: {playlist_name}")
     playlist = YouTubePlaylist.objects.create(
@@ -360,7 +344,8 @@ def make_playlist(playlist_id, playlist_name, playlist_thumbnail, song_dataset,
     )
     process_image(playlist, playlist_thumbnail)
 
-    playlist.tracks.set(song_objects)
-
-
-set_word_list()
+    YouTubePlaylistTrack.objects.bulk_create(
+        [YouTubePlaylistTrack(playlist_id=playlist.id, song_id=song.id, position=counter)
+         for counter, song in songs.items()],
+        update_conflicts=True, unique_fields=["playlist", "song"], update_fields=["position"],
+    )
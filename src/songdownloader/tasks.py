@@ -3,34 +3,109 @@ import os
 import tempfile
 from datetime import datetime
 
-import redis
 import requests
+from celery import chord
 from celery.utils.log import get_task_logger
 from django.contrib.auth import get_user_model
 from django.core.files import File
 
 from PaulStudios import settings
 from PaulStudios.celery import app
-from base.tasks import delete_folder, increase_progress, set_progress, delete_task_data, update_progress
+from base.tasks import (delete_folder, increase_progress, set_progress, set_progress_fields, delete_task_data,
+                        update_progress)
 from .models import SpotifySong, SpotifyPlaylist, UserLogRecent, YouTubeSong, YouTubePlaylist
-from .services.downloader import downloader, make_yt_link
+from .services.downloader import DownloadSession, downloader, job_folder, make_yt_link, zip_files
 from .services.spotify import Spotify, get_track_details, search_song
 from .services import youtube, spotify
 from .services.youtube import Youtube as YT, parse_video_id
 
 logger = get_task_logger(__name__)
 User = get_user_model()
-redis_db = redis.from_url(settings.REDIS_URL, decode_responses=True)
+
+
+def use_fanout(track_count):
+    return settings.SONGDOWNLOADER_FANOUT and track_count >= settings.SONGDOWNLOADER_FANOUT_MIN_TRACKS
+
+
+def spotify_download_task(counter, song):
+    return {
+        "url": make_yt_link(song.youtube_video_id),
+        "name": f"{str(counter)}. {song.name} [{song.artists.split(', ')[0]}]",
+        "video_id": song.youtube_video_id,
+    }
+
+
+def youtube_download_task(counter, song):
+    return {
+        "url": make_yt_link(song.id),
+        "name": f"{str(counter)}. {song.name} [{song.artists.split(', ')[0]}]",
+        "video_id": song.id,
+    }
+
+
+def fan_out_downloads(download_task_list, name, user_id, task_id, userlog_id, total_steps, state_meta):
+    size = settings.SONGDOWNLOADER_FANOUT_CHUNK_SIZE
+    chunks = [download_task_list[i:i + size] for i in range(0, len(download_task_list), size)]
+    logger.info(f"Dispatching {len(chunks)} download chunks for {name}")
+    header = [download_chunk.s(chunk, name, str(user_id), task_id) for chunk in chunks]
+    return chord(header, build_archive.s(user_id, name, userlog_id, total_steps, state_meta))
+
+
+def finish_job(task, user_id, name, downloads, failures, filepath, folder, userlog_id, total_steps, state_meta):
+    task.update_state(state="DONE", meta=state_meta)
+
+    set_progress(total_steps, task.request.id)
+
+    delete_folder.apply_async((os.path.join(folder, name),), countdown=10)
+    delete_task_data.apply_async((userlog_id,), countdown=90 * 60)
+
+    return {
+        "user": str(user_id),
+        "name": name,
+        "path": filepath,
+        "success": len(downloads),
+        "fail": len(failures),
+        "extra": {
+            "successful_downloads": downloads,
+            "failed_downloads": failures
+        }
+    }
+
+
+def abort_session(session):
+    session.abort()
+    # Tracks that were already downloading still land in the folder, so it
+    # is removed once they are done.
+    delete_folder.apply_async((os.path.join(session.folder, session.zip_name),), countdown=10 * 60)
+
+
+@app.task(bind=True)
+def download_chunk(self, tasks, zip_name, folder, task_id):
+    session = DownloadSession(zip_name, folder, task_id, archive=False)
+    session.run(tasks)
+    return {
+        "files": session.successful_downloads,
+        "failures": session.failed_downloads,
+    }
+
+
+@app.task(bind=True)
+def build_archive(self, results, user_id, name, userlog_id, total_steps, state_meta):
+    files = [file_path for result in results for file_path in result["files"]]
+    failures = [failure for result in results for failure in result["failures"]]
+    folder = job_folder(str(user_id))
+    logger.info(f"Creating ZIP file for {name} from {len(results)} chunks")
+    filepath = zip_files(files, name, folder)
+    downloads = [os.path.basename(i) for i in files]
+    return finish_job(self, user_id, name, downloads, failures, filepath, folder, userlog_id, total_steps, state_meta)
 
 
 @app.task(bind=True)
 def spotify_playlist(self, user_id, url):
     user = User.objects.get(pk=user_id)
     spotify_object = Spotify("Playlist", url)
-    set_progress(0, self.request.id)
-    redis_db.set(f"image-{self.request.id}", "/static/image_loading.svg")
-    redis_db.set(f"current-{self.request.id}", "loading")
-    redis_db.set(f"name-{self.request.id}", spotify_object.data.name)
+    set_progress_fields(self.request.id, progress=0, image="/static/image_loading.svg", current="loading",
+                        name=spotify_object.data.name)
 
     userlog = UserLogRecent.objects.create(
         user=user,
@@ -48,68 +123,70 @@ def spotify_playlist(self, user_id, url):
         "id": spotify_object.id
     }
     self.update_state(state="Getting list of Tracks", meta=state_meta)
-    spotify_object.data.get_tracks_list()
-    list_of_songs = spotify_object.data.track_list
-
-    total_steps = (len(list_of_songs) + 1) * 2
-    redis_db.set(f"total-{self.request.id}", total_steps)
 
-    self.update_state(state="Parsing Tracks", meta=state_meta)
-
-    if not SpotifyPlaylist.objects.filter(id=spotify_object.id).exists():
-        spotify.make_playlist(spotify_object.id, spotify_object.data, list_of_songs, self.request.id)
+    # An unchanged snapshot means the stored tracks are still current, so the
+    # track list is not fetched at all.
+    playlist = SpotifyPlaylist.objects.filter(id=spotify_object.id).first()
+    unchanged = playlist is not None and playlist.snapshot_id == spotify_object.data.snapshot_id
+    if unchanged:
+        logger.info(f"{playlist.name} is unchanged since snapshot {playlist.snapshot_id}")
+        list_of_songs = []
+        track_count = playlist.tracks.count()
     else:
-        playlist = SpotifyPlaylist.objects.get(id=spotify_object.id)
-        id_list_local = [song['track']['id'] for song in list_of_songs]
-        id_list_db = [song.id for song in playlist.tracks.all()]
-        id_list_local = [i for n, i in enumerate(id_list_local) if i not in id_list_local[:n]]
-        if not id_list_local.sort() == id_list_db.sort():
-            playlist.delete()
-            spotify.make_playlist(spotify_object.id, spotify_object.data, list_of_songs, self.request.id)
-
-    set_progress((total_steps // 2), self.request.id)
-    playlist = SpotifyPlaylist.objects.get(id=spotify_object.id)
-    songs = playlist.tracks.all()
-
-    redis_db.set(f"image-{self.request.id}", playlist.image.url)
-    redis_db.set(f"current-{self.request.id}", "loading")
-    increase_progress(self.request.id)
+        spotify_object.data.get_tracks_list()
+        list_of_songs = spotify_object.data.track_list
+        track_count = len(list_of_songs)
 
-    self.update_state(state="Downloading and Zipping", meta=state_meta)
+    total_steps = (track_count + 1) * 2
+    set_progress_fields(self.request.id, total=total_steps)
 
-    logger.info(f"Creating download list for {playlist.name}")
-    download_task_list = []
-    for counter, song in enumerate(songs, 1):
-        song_name = f"{str(counter)}. {song.name} [{song.artists.split(', ')[0]}]"
-        task = {
-            "url": make_yt_link(song.youtube_video_id),
-            "name": song_name,
-        }
-        download_task_list.append(task)
+    self.update_state(state="Parsing Tracks", meta=state_meta)
 
-    increase_progress(self.request.id)
+    # Unless the playlist gets fanned out, every track is queued for download
+    # as soon as it has been resolved.
+    session = None
+    if not use_fanout(track_count):
+        session = DownloadSession(spotify_object.data.name, str(user_id), self.request.id).start()
+
+    def on_track(counter, song):
+        if session:
+            session.put(spotify_download_task(counter, song))
+
+    try:
+        if playlist is None:
+            spotify.make_playlist(spotify_object.id, spotify_object.data, list_of_songs, self.request.id, on_track)
+        elif not unchanged:
+            spotify.sync_playlist(playlist, spotify_object.data, list_of_songs, self.request.id, on_track)
+
+        pipelined = session is not None and session.queued > 0
+        if not pipelined:
+            set_progress((total_steps // 2), self.request.id)
+        playlist = SpotifyPlaylist.objects.get(id=spotify_object.id)
 
-    logger.info("Starting downloads")
-    downloads, failures, filepath, folder = downloader(download_task_list, playlist.name, str(user_id), self.request.id)
+        set_progress_fields(self.request.id, image=playlist.image.url, current="loading")
+        increase_progress(self.request.id)
 
-    self.update_state(state="DONE", meta=state_meta)
+        self.update_state(state="Downloading and Zipping", meta=state_meta)
 
-    set_progress(total_steps, self.request.id)
+        if not pipelined:
+            logger.info(f"Creating download list for {playlist.name}")
+            download_task_list = [spotify_download_task(counter, song)
+                                  for counter, song in playlist.ordered_tracks()]
+            if session is None:
+                raise self.replace(fan_out_downloads(download_task_list, playlist.name, user_id, self.request.id,
+                                                     str(userlog.id), total_steps, state_meta))
+            logger.info("Starting downloads")
+            for task in download_task_list:
+                session.put(task)
 
-    delete_folder.apply_async((os.path.join(folder, playlist.name),), countdown=10)
-    delete_task_data.apply_async((userlog.id,), countdown=90 * 60)
+        downloads, failures, filepath, folder = session.finish()
+    except Exception:
+        if session is not None:
+            abort_session(session)
+        raise
 
-    return {
-        "user": str(user.id),
-        "name": playlist.name,
-        "path": filepath,
-        "success": len(downloads),
-        "fail": len(failures),
-        "extra": {
-            "successful_downloads": downloads,
-            "failed_downloads": failures
-        }
-    }
+    return finish_job(self, user_id, playlist.name, downloads, failures, filepath, folder,
+                      userlog.id, total_steps, state_meta)
 
 
 @app.task(bind=True)
@@ -117,10 +194,8 @@ def spotify_track(self, user_id, url):
     user = User.objects.get(pk=user_id)
     spotify_object = Spotify("Track", url)
 
-    set_progress(1, self.request.id)
-    redis_db.set(f"total-{self.request.id}", 3)
-    redis_db.set(f"image-{self.request.id}", "/static/image_loading.svg")
-    redis_db.set(f"current-{self.request.id}", spotify_object.data.name)
+    set_progress_fields(self.request.id, progress=1, total=3, image="/static/image_loading.svg",
+                        current=spotify_object.data.name)
 
     userlog = UserLogRecent.objects.create(
         user=user,
@@ -142,12 +217,13 @@ def spotify_track(self, user_id, url):
     logger.info('Starting Parsing process')
     track_raw = spotify_object.data.get_track_data(spotify_object.id)
 
-    song = spotify.process_track(track_raw, 1, 1, "Single", self.request.id)
+    song = spotify.process_track(spotify.compact_track(track_raw), 1, 1, "Single", self.request.id)
 
     song_name = f"{song.name} [{song.artists.split(', ')[0]}]"
     task = [{
         "url": make_yt_link(song.youtube_video_id),
         "name": song_name,
+        "video_id": song.youtube_video_id,
     }]
 
     self.update_state(state="Downloading", meta=state_meta)
@@ -177,9 +253,8 @@ def youtube_playlist(self, user_id, url):
     set_progress(0, self.request.id)
     youtube_object = YT("Playlist", url)
     youtube_object.data.get_playlist_details()
-    redis_db.set(f"image-{self.request.id}", "/static/image_loading.svg")
-    redis_db.set(f"current-{self.request.id}", "loading")
-    redis_db.set(f"name-{self.request.id}", youtube_object.data.name)
+    set_progress_fields(self.request.id, image="/static/image_loading.svg", current="loading",
+                        name=youtube_object.data.name)
 
     userlog = UserLogRecent.objects.create(
         user=user,
@@ -199,66 +274,59 @@ def youtube_playlist(self, user_id, url):
     self.update_state(state="Getting list of Tracks", meta=state_meta)
 
     total_tracks = youtube_object.data.num_of_tracks
-    steps = total_tracks * 2
-    print(steps)
+    # Listing, parsing and downloading each take one step per track, plus
+    # one for the playlist details.
+    steps = total_tracks * 3 + 1
 
-    redis_db.set(f"total-{self.request.id}", steps)
+    set_progress_fields(self.request.id, total=steps)
     increase_progress(self.request.id)
 
     self.update_state(state="Parsing Tracks", meta=state_meta)
 
-    if not YouTubePlaylist.objects.filter(id=youtube_object.id).exists():
-        youtube_object.data.get_videos(self.request.id)
-        df = youtube_object.data.dataset
-        #  df.dropna(inplace=True)
-        df.drop_duplicates(inplace=True)
-        dataset = df.to_dict()
-        youtube.make_playlist(youtube_object.id, youtube_object.data.name,
-                              youtube_object.data.image, dataset,
-                              total_tracks, self.request.id)
-
-    set_progress((total_tracks * 2) + 2, self.request.id)
-    playlist = YouTubePlaylist.objects.get(id=youtube_object.id)
-    songs = playlist.tracks.all()
-
-    redis_db.set(f"image-{self.request.id}", playlist.image.url)
-    redis_db.set(f"current-{self.request.id}", "loading")
-
-    self.update_state(state="Downloading and Zipping", meta=state_meta)
-
-    logger.info(f"Creating download list for {playlist.name}")
-    download_task_list = []
-
-    for counter, song in enumerate(songs, 1):
-        song_name = f"{str(counter)}. {song.name} [{song.artists.split(', ')[0]}]"
-        task = {
-            "url": make_yt_link(song.id),
-            "name": song_name,
-        }
-        download_task_list.append(task)
+    # Unless the playlist gets fanned out, every track is queued for download
+    # as soon as it has been parsed.
+    session = None
+    if not use_fanout(total_tracks):
+        session = DownloadSession(youtube_object.data.name, str(user_id), self.request.id).start()
 
-    set_progress(steps - len(download_task_list) - 1, self.request.id)
-    logger.info("Starting downloads")
-    downloads, failures, filepath, folder = downloader(download_task_list, playlist.name, str(user_id), self.request.id)
+    def on_track(counter, song):
+        if session:
+            session.put(youtube_download_task(counter, song))
 
-    self.update_state(state="DONE", meta=state_meta)
+    try:
+        if not YouTubePlaylist.objects.filter(id=youtube_object.id).exists():
+            youtube_object.data.get_videos(self.request.id)
+            youtube.make_playlist(youtube_object.id, youtube_object.data.name,
+                                  youtube_object.data.image, youtube_object.data.track_list,
+                                  total_tracks, self.request.id, on_track)
 
-    set_progress(steps, self.request.id)
+        pipelined = session is not None and session.queued > 0
+        playlist = YouTubePlaylist.objects.get(id=youtube_object.id)
 
-    delete_folder.apply_async((os.path.join(folder, playlist.name),), countdown=10)
-    delete_task_data.apply_async((userlog.id,), countdown=90 * 60)
+        set_progress_fields(self.request.id, image=playlist.image.url, current="loading")
 
-    return {
-        "user": str(user.id),
-        "name": playlist.name,
-        "path": filepath,
-        "success": len(downloads),
-        "fail": len(failures),
-        "extra": {
-            "successful_downloads": downloads,
-            "failed_downloads": failures
-        }
-    }
+        self.update_state(state="Downloading and Zipping", meta=state_meta)
+
+        if not pipelined:
+            logger.info(f"Creating download list for {playlist.name}")
+            download_task_list = [youtube_download_task(counter, song)
+                                  for counter, song in playlist.ordered_tracks()]
+            set_progress(steps - len(download_task_list), self.request.id)
+            if session is None:
+                raise self.replace(fan_out_downloads(download_task_list, playlist.name, user_id, self.request.id,
+                                                     str(userlog.id), steps, state_meta))
+            logger.info("Starting downloads")
+            for task in download_task_list:
+                session.put(task)
+
+        downloads, failures, filepath, folder = session.finish()
+    except Exception:
+        if session is not None:
+            abort_session(session)
+        raise
+
+    return finish_job(self, user_id, playlist.name, downloads, failures, filepath, folder,
+                      userlog.id, steps, state_meta)
 
 
 @app.task(bind=True)
@@ -266,12 +334,10 @@ def youtube_track(self, user_id, url):
     user = User.objects.get(pk=user_id)
     set_progress(0, self.request.id)
     youtube_object = YT("Track", url)
-    redis_db.set(f"total-{self.request.id}", 3)
+    set_progress_fields(self.request.id, total=3)
     youtube_object.data.get_video_details()
 
-    redis_db.set(f"total-{self.request.id}", 3)
-    redis_db.set(f"image-{self.request.id}", "/static/image_loading.svg")
-    redis_db.set(f"current-{self.request.id}", youtube_object.data.name)
+    set_progress_fields(self.request.id, image="/static/image_loading.svg", current=youtube_object.data.name)
 
     userlog = UserLogRecent.objects.create(
         user=user,
@@ -297,6 +363,7 @@ def youtube_track(self, user_id, url):
     task = [{
         "url": make_yt_link(song.video_id),
         "name": song.name,
+        "video_id": song.video_id,
     }]
     increase_progress(self.request.id)
 
@@ -1,3 +1,791 @@
-from django.test import TestCase
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import zipfile
+from datetime import timedelta
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
 
-# Create your tests here.
+from django.db import connection
+from django.test import TestCase as DatabaseTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.core.files.storage import default_storage
+from django.utils import timezone
+from PIL import Image
+
+from .models import SpotifyPlaylist, SpotifySong, TrackResolution, YouTubePlaylist
+from . import tasks
+from .services import artists, images, quota, resolver, spotify, wordlist, youtube
+from .services.audio_cache import AudioCache
+from .services.downloader import MAX_SIMULTANEOUS_DOWNLOADS, DownloadSession, run_bounded, zip_files
+
+
+def fake_youtube_download(url, name, folder):
+    os.makedirs(folder, exist_ok=True)
+    with open(os.path.join(folder, name + ".mp3"), "wb") as f:
+        return f.write(url.encode())
+
+
+@patch('songdownloader.services.downloader.increase_progress')
+@patch('songdownloader.services.downloader.download_youtube_mp3', side_effect=fake_youtube_download)
+class DownloadSessionTestCase(TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+
+    def make_tasks(self, prefix, count):
+        return [{"url": f"https://www.youtube.com/watch?v={prefix}{i}", "name": f"{prefix}{i}"}
+                for i in range(count)]
+
+    def test_sessions_are_isolated(self, mock_download, mock_progress):
+        results = {}
+
+        def run(name):
+            results[name] = DownloadSession(name, self.folder, name).run(self.make_tasks(name, 20))
+
+        threads = [threading.Thread(target=run, args=(name,)) for name in ("first", "second")]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        for name in ("first", "second"):
+            downloads, failures, zip_path, folder = results[name]
+            self.assertEqual(len(downloads), 20)
+            self.assertEqual(failures, [])
+            with zipfile.ZipFile(zip_path) as zipf:
+                self.assertTrue(all(n.startswith(name) for n in zipf.namelist()))
+                self.assertEqual(len(zipf.namelist()), 20)
+                for info in zipf.infolist():
+                    self.assertEqual(info.compress_type, zipfile.ZIP_STORED)
+            self.assertEqual(os.listdir(os.path.join(folder, name)), [])
+
+    def test_no_archive_without_downloads(self, mock_download, mock_progress):
+        downloads, failures, zip_path, folder = DownloadSession("empty", self.folder, "empty").run([])
+        self.assertEqual(downloads, [])
+        self.assertFalse(os.path.exists(zip_path))
+
+    @patch('songdownloader.services.downloader.requests.get')
+    def test_http_download_streams_to_disk(self, mock_get, mock_download, mock_progress):
+        response = MagicMock()
+        response.__enter__.return_value = response
+        response.iter_content.return_value = [b"a" * 10, b"b" * 5]
+        mock_get.return_value = response
+
+        session = DownloadSession("http", self.folder, "http")
+        downloads, failures, zip_path, folder = session.run([{"url": "https://example.com/cover.png", "name": "cover.png"}])
+
+        self.assertEqual(downloads, ["cover.png"])
+        self.assertEqual(session.stats["bytes"], 15)
+        self.assertTrue(mock_get.call_args.kwargs["stream"])
+
+    def test_repeated_video_ids_download_once(self, mock_download, mock_progress):
+        tasks = [{"url": "https://www.youtube.com/watch?v=same", "name": f"{i}. Song", "video_id": "same"}
+                 for i in range(1, 6)]
+        cache = AudioCache(os.path.join(self.folder, "cache"), 1024 * 1024)
+        with patch('songdownloader.services.downloader.audio_cache', cache):
+            session = DownloadSession("dupes", self.folder, "dupes")
+            downloads, failures, zip_path, folder = session.run(tasks)
+
+        self.assertEqual(len(downloads), 5)
+        self.assertEqual(mock_download.call_count, 1)
+        self.assertEqual(session.stats["cache_hits"], 4)
+
+    def test_chunks_are_archived_together(self, mock_download, mock_progress):
+        files = []
+        for prefix in ("a", "b"):
+            session = DownloadSession("chunked", self.folder, "chunked", archive=False)
+            downloads, failures, zip_path, folder = session.run(self.make_tasks(prefix, 3))
+            self.assertIsNone(zip_path)
+            files.extend(session.successful_downloads)
+
+        zip_path = zip_files(files, "chunked", folder)
+        with zipfile.ZipFile(zip_path) as zipf:
+            self.assertEqual(sorted(zipf.namelist()), sorted(os.path.basename(f) for f in files))
+
+    def test_abort_drops_queued_tracks(self, mock_download, mock_progress):
+        release = threading.Event()
+
+        def blocked_download(url, name, folder):
+            release.wait(5)
+            return fake_youtube_download(url, name, folder)
+
+        mock_download.side_effect = blocked_download
+        session = DownloadSession("aborted", self.folder, "aborted").start()
+        for task in self.make_tasks("a", 30):
+            session.put(task)
+
+        session.abort()
+        release.set()
+        deadline = time.monotonic() + 5
+        while session._runners and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        self.assertEqual(session._runners, 0)
+        self.assertEqual(mock_download.call_count, MAX_SIMULTANEOUS_DOWNLOADS)
+        self.assertFalse(session._writer._thread.is_alive())
+        self.assertFalse(os.path.exists(session.zip_path))
+
+
+class AudioCacheTestCase(TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+        self.cache = AudioCache(os.path.join(self.folder, "cache"), 10)
+
+    def make_file(self, name, size):
+        path = os.path.join(self.folder, name)
+        with open(path, "wb") as f:
+            f.write(b"x" * size)
+        return path
+
+    def test_put_and_get(self):
+        self.cache.put("a", self.make_file("a.mp3", 4))
+        self.assertTrue(self.cache.get("a").endswith("a.mp3"))
+        self.assertIsNone(self.cache.get("missing"))
+
+    def test_evicts_least_recently_used(self):
+        self.cache.put("a", self.make_file("a.mp3", 4))
+        self.cache.put("b", self.make_file("b.mp3", 4))
+        self.cache.get("a")
+        self.cache.put("c", self.make_file("c.mp3", 4))
+        self.assertIsNotNone(self.cache.get("a"))
+        self.assertIsNone(self.cache.get("b"))
+        self.assertIsNotNone(self.cache.get("c"))
+
+
+class WordListTestCase(TestCase):
+
+    def setUp(self):
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        self.path = os.path.join(folder, "words.txt")
+
+    @patch('songdownloader.services.wordlist.requests.get')
+    def test_build_and_lookup(self, mock_get):
+        mock_get.side_effect = [MagicMock(status_code=200, text="Love\nzebra\napple\n"),
+                                MagicMock(status_code=200, text="apple\r\nmoon\n\ncafé")]
+        self.assertEqual(wordlist.build(self.path, ["a", "b"]), 5)
+
+        words = wordlist.WordList(self.path)
+        for word in ("apple", "café", "love", "moon", "zebra"):
+            self.assertTrue(words.lookup(word), word)
+        for word in ("", "a", "appl", "apples", "love ", "zz", "arijit"):
+            self.assertFalse(words.lookup(word), word)
+
+    def test_missing_file_matches_nothing(self):
+        self.assertFalse(wordlist.WordList(self.path).lookup("apple"))
+
+
+class RunBoundedTestCase(TestCase):
+
+    def test_yields_every_position_with_bounded_window(self):
+        lock = threading.Lock()
+        in_flight = []
+        peak = []
+
+        def work(value):
+            with lock:
+                in_flight.append(value)
+                peak.append(len(in_flight))
+            with lock:
+                in_flight.remove(value)
+            return value * 2
+
+        results = dict(run_bounded(work, ((i,) for i in range(1, 101)), window=4))
+        self.assertEqual(results, {i: i * 2 for i in range(1, 101)})
+        self.assertLessEqual(max(peak), 4)
+
+
+@patch('songdownloader.services.spotify.redis_db')
+@patch('songdownloader.services.spotify.requests.post')
+class SpotifyTokenTestCase(TestCase):
+
+    def test_cached_token_skips_spotify(self, mock_post, mock_redis):
+        mock_redis.get.return_value = "cached"
+        self.assertEqual(spotify.get_access_token(), "cached")
+        mock_post.assert_not_called()
+
+    def test_new_token_is_stored_with_expiry(self, mock_post, mock_redis):
+        mock_redis.get.return_value = None
+        mock_post.return_value.json.return_value = {"access_token": "fresh", "expires_in": 3600}
+        self.assertEqual(spotify.get_access_token(), "fresh")
+        mock_redis.set.assert_called_once_with(spotify.TOKEN_KEY, "fresh",
+                                               ex=3600 - spotify.TOKEN_REFRESH_MARGIN)
+
+
+@patch('songdownloader.services.spotify.METADATA_TTL', 0)
+@patch('songdownloader.services.spotify.requests.get')
+class SpotifyMetadataTestCase(TestCase):
+
+    def test_playlist_document_is_fetched_once(self, mock_get):
+        mock_get.return_value.json.return_value = {
+            "name": "Mix", "snapshot_id": "snap", "images": [{"url": "https://i.scdn.co/a"}],
+            "tracks": {"total": 0, "items": []},
+        }
+        playlist = spotify.Spotify._SpotifyPlaylist("abc", "token")
+        self.assertEqual(playlist.name, "Mix")
+        self.assertEqual(playlist.image, "https://i.scdn.co/a")
+        self.assertEqual(playlist.snapshot_id, "snap")
+        playlist.get_tracks_list()
+        self.assertEqual(mock_get.call_count, 1)
+        self.assertEqual(mock_get.call_args.kwargs["params"], {"fields": spotify.PLAYLIST_FIELDS})
+
+    def test_track_document_is_fetched_once(self, mock_get):
+        mock_get.return_value.json.return_value = {"id": "t1", "name": "Song"}
+        track = spotify.Spotify._SpotifyTrack("t1", "token")
+        self.assertEqual(track.name, "Song")
+        self.assertEqual(track.get_track_data("t1")["id"], "t1")
+        self.assertEqual(mock_get.call_count, 1)
+
+
+def spotify_item(track_id, name="Song"):
+    return {"track": {"id": track_id, "name": name, "artists": [{"name": "A"}, {"name": "B"}],
+                      "album": {"images": [{"url": f"https://i.scdn.co/{track_id}"}]}}}
+
+
+class SpotifyPaginationTestCase(TestCase):
+
+    @patch('songdownloader.services.spotify.http.get')
+    def test_pages_are_fetched_by_offset_and_deduplicated(self, mock_get):
+        def page(url, headers, params):
+            offset = params["offset"]
+            response = MagicMock(status_code=200)
+            response.json.return_value = {"items": [spotify_item(f"t{i % 150}") for i in range(offset, min(offset + 100, 250))]}
+            return response
+
+        mock_get.side_effect = page
+        playlist = spotify.Spotify._SpotifyPlaylist("abc", "token")
+        playlist._data = {"tracks": {"total": 250, "items": [spotify_item(f"t{i}") for i in range(50)]}}
+        playlist.get_tracks_list()
+
+        self.assertEqual(sorted(call.kwargs["params"]["offset"] for call in mock_get.call_args_list), [50, 150])
+        self.assertEqual([track.id for track in playlist.track_list], [f"t{i}" for i in range(150)])
+        self.assertEqual(playlist.track_list[0], spotify.SpotifyTrackItem("t0", "Song", "A, B", "https://i.scdn.co/t0"))
+
+
+COMMON_WORDS = {"the", "band", "hand", "night", "team", "imagine", "dragons", "love", "official", "video"}
+
+
+@patch('songdownloader.services.artists.is_common_word', side_effect=lambda word: word in COMMON_WORDS)
+class ArtistExtractionTestCase(TestCase):
+
+    def test_only_all_common_words_are_rejected(self, mock_words):
+        self.assertEqual(artists.extract_artist("Blinding Lights", "Official audio by The Weeknd", []), "The Weeknd")
+        # A rejected candidate falls through to the title instead of giving up.
+        self.assertEqual(artists.extract_artist("Heat Waves | Glass Animals", "Written by the band", []),
+                         "Glass Animals")
+        self.assertEqual(artists.extract_artist("Love", "made by hand", ["love"]), artists.UNKNOWN_ARTIST)
+
+    def test_title_patterns(self, mock_words):
+        cases = {
+            "Shreya Ghoshal - Topic": "Shreya Ghoshal",
+            "Coldplay: Yellow": "Coldplay",
+            "Levitating - Dua Lipa": "Dua Lipa",
+            "Channa Mereya | Arijit Singh | Pritam": "Arijit Singh",
+            "\"Shape of You\" by Ed Sheeran": "Ed Sheeran",
+        }
+        self.assertEqual(artists.extract_artists((title, "", []) for title in cases), list(cases.values()))
+
+    def test_corpus_accuracy(self, mock_words):
+        with open(os.path.join(os.path.dirname(__file__), "data", "artist_corpus.json"), encoding="utf-8") as fh:
+            corpus = json.load(fh)
+        results = artists.extract_artists((entry["title"], entry["description"], entry["tags"]) for entry in corpus)
+        hits = sum(result == entry["artist"] for entry, result in zip(corpus, results))
+        self.assertGreaterEqual(hits / len(corpus), 0.8)
+
+
+def youtube_page(ids, next_page_token=None):
+    return {
+        "items": [{"snippet": {"title": video_id, "thumbnails": {"high": {"url": f"https://i.ytimg.com/{video_id}"}}},
+                   "contentDetails": {"videoId": video_id}} for video_id in ids],
+        "nextPageToken": next_page_token,
+    }
+
+
+@patch('songdownloader.services.quota.redis_db')
+@patch('songdownloader.services.youtube.increase_progress')
+@patch('songdownloader.services.youtube.get_client')
+class YoutubePlaylistTestCase(TestCase):
+
+    def test_video_details_are_fetched_per_page(self, mock_build, mock_progress, mock_redis):
+        # v3 is listed twice
+        ids = [f"v{i}" for i in range(59)] + ["v3"]
+        pages = {None: youtube_page(ids[:50], "page-2"), "page-2": youtube_page(ids[50:])}
+
+        threads = {}
+
+        def list_items(**kwargs):
+            threads[kwargs["pageToken"]] = threading.current_thread().name
+            return MagicMock(execute=lambda http=None: pages[kwargs["pageToken"]])
+
+        def list_videos(**kwargs):
+            # v7 is private, so it is missing from the response
+            items = [{"id": video_id, "snippet": {"description": "", "tags": []}}
+                     for video_id in kwargs["id"].split(",") if video_id != "v7"]
+            return MagicMock(execute=lambda: {"items": items})
+
+        mock_redis.get.return_value = None
+        client = mock_build.return_value
+        client.playlistItems.return_value.list.side_effect = list_items
+        client.videos.return_value.list.side_effect = list_videos
+
+        playlist = youtube.Youtube.YoutubePlaylist("PL1", "key")
+        playlist.get_videos("task")
+
+        requested = [call.kwargs["id"].split(",") for call in client.videos.return_value.list.call_args_list]
+        self.assertEqual(requested, [ids[:50], ids[50:]])
+        self.assertEqual([video.url for video in playlist.track_list],
+                         [f"https://www.youtube.com/watch?v={video_id}" for video_id in ids[:59] if video_id != "v7"])
+        self.assertEqual(mock_progress.call_count, 59)
+        self.assertTrue(threads["page-2"].startswith("youtube-prefetch"))
+
+    def test_descriptions_are_skipped_when_quota_is_low(self, mock_build, mock_progress, mock_redis):
+        mock_redis.get.return_value = str(quota.DAILY_QUOTA - quota.LOW_QUOTA + 1)
+        client = mock_build.return_value
+        client.playlistItems.return_value.list.return_value.execute.return_value = {"items": [
+            {"snippet": {"title": "Levitating - Dua Lipa", "thumbnails": {}}, "contentDetails": {"videoId": "v1"}},
+            {"snippet": {"title": "Private video", "thumbnails": {}}, "contentDetails": {"videoId": "v2"}},
+            {"snippet": {"title": "Deleted video", "thumbnails": {}}, "contentDetails": {"videoId": "v3"}},
+        ]}
+
+        playlist = youtube.Youtube.YoutubePlaylist("PL1", "key")
+        playlist.get_videos("task")
+
+        client.videos.assert_not_called()
+        self.assertEqual([video.artist for video in playlist.track_list], ["Dua Lipa"])
+
+    def test_listing_fails_early_without_quota(self, mock_build, mock_progress, mock_redis):
+        # Three pages need three listing and three details calls.
+        mock_redis.get.return_value = str(quota.DAILY_QUOTA - 5)
+        playlist = youtube.Youtube.YoutubePlaylist("PL1", "key")
+        playlist.content_details = {"itemCount": 120}
+
+        with self.assertRaises(quota.QuotaExceeded):
+            playlist.get_videos("task")
+        mock_build.return_value.playlistItems.assert_not_called()
+
+    def test_playlist_details_are_fetched_once(self, mock_build, mock_progress, mock_redis):
+        client = mock_build.return_value
+        client.playlists.return_value.list.return_value.execute.return_value = {"items": [{
+            "snippet": {"title": "Mix", "thumbnails": {"high": {"url": "https://i.ytimg.com/mix"}}},
+            "contentDetails": {"itemCount": 12},
+        }]}
+
+        playlist = youtube.Youtube.YoutubePlaylist("PL1", "key")
+        playlist.get_playlist_details()
+
+        self.assertEqual((playlist.name, playlist.image, playlist.num_of_tracks),
+                         ("Mix", "https://i.ytimg.com/mix", 12))
+        client.playlists.return_value.list.assert_called_once_with(part="snippet,contentDetails", id="PL1")
+
+    def test_track_details_are_fetched_once(self, mock_build, mock_progress, mock_redis):
+        client = mock_build.return_value
+        client.videos.return_value.list.return_value.execute.return_value = {"items": [{
+            "snippet": {"title": "Song", "description": "Singer: Someone",
+                        "thumbnails": {"high": {"url": "https://i.ytimg.com/song"}}},
+        }]}
+
+        track = youtube.Youtube.YoutubeTrack("v1", "key")
+        track.get_video_details()
+        track.get_artists()
+
+        self.assertEqual((track.name, track.thumbnail, track.artist), ("Song", "https://i.ytimg.com/song", "Someone"))
+        client.videos.return_value.list.assert_called_once_with(part="snippet,contentDetails", id="v1")
+
+
+@patch('songdownloader.services.youtube._discovery_document', None)
+@patch('songdownloader.services.youtube.discovery_cache.get_static_doc', return_value='{"name": "youtube"}')
+@patch('songdownloader.services.youtube.build_from_document', side_effect=lambda document, **kwargs: object())
+class YoutubeClientTestCase(TestCase):
+
+    def test_one_client_per_thread(self, mock_build, mock_document):
+        with patch.object(youtube, "_clients", threading.local()):
+            client = youtube.get_client()
+            self.assertIs(youtube.get_client(), client)
+
+            other = []
+            thread = threading.Thread(target=lambda: other.append(youtube.get_client()))
+            thread.start()
+            thread.join()
+
+        self.assertIsNot(other[0], client)
+        mock_document.assert_called_once_with("youtube", "v3")
+        self.assertEqual([call.args[0] for call in mock_build.call_args_list], [{"name": "youtube"}] * 2)
+        self.assertIs(mock_build.call_args.kwargs["requestBuilder"], quota.MeteredHttpRequest)
+
+
+@patch('songdownloader.services.quota.time.sleep')
+@patch('songdownloader.services.quota._reserve')
+class QuotaTestCase(TestCase):
+
+    def test_waits_for_the_token_bucket(self, mock_reserve, mock_sleep):
+        mock_reserve.side_effect = [[0, "0.25"], [1, 41]]
+        self.assertEqual(quota.reserve("youtube.videos.list"), 41)
+        mock_sleep.assert_called_once_with(0.25)
+        self.assertEqual(mock_reserve.call_args.kwargs["args"][0], 1)
+
+    def test_search_costs_more(self, mock_reserve, mock_sleep):
+        mock_reserve.return_value = [1, 100]
+        quota.reserve("youtube.search.list")
+        self.assertEqual(mock_reserve.call_args.kwargs["args"][0], 100)
+
+    def test_raises_when_quota_is_spent_or_wait_is_too_long(self, mock_reserve, mock_sleep):
+        for result in ([-1, 0], [0, str(quota.MAX_WAIT + 1)]):
+            mock_reserve.side_effect = [result]
+            with self.assertRaises(quota.QuotaExceeded):
+                quota.reserve("youtube.videos.list")
+        mock_sleep.assert_not_called()
+
+
+class ResolverTestCase(DatabaseTestCase):
+
+    def test_hits_and_misses_are_cached(self):
+        search = MagicMock(return_value="vid1")
+        self.assertEqual(resolver.resolve("t1", "Song", "Artist", search), "vid1")
+        self.assertEqual(resolver.resolve("t1", "Song", "Artist", search), "vid1")
+        self.assertEqual(search.call_count, 1)
+
+        miss = MagicMock(return_value=None)
+        self.assertIsNone(resolver.resolve("t2", "Other", "Artist", miss))
+        self.assertIsNone(resolver.resolve("t2", "Other", "Artist", miss))
+        self.assertEqual(miss.call_count, 1)
+
+    def test_same_song_from_another_track_id_is_reused(self):
+        resolver.resolve("t1", "Song (Remix)", "Artist", MagicMock(return_value="vid1"))
+        search = MagicMock(return_value="vid2")
+        self.assertEqual(resolver.resolve("t9", "song remix", "ARTIST", search), "vid1")
+        search.assert_not_called()
+
+    def test_long_titles_fit_the_key_column(self):
+        key = resolver.song_key("Song " * 200, ", ".join(f"Artist {i}" for i in range(100)))
+        self.assertLessEqual(len(key), TrackResolution._meta.get_field("key").max_length)
+
+        search = MagicMock(return_value="vid1")
+        self.assertEqual(resolver.resolve("t1", "Song " * 200, "Artist", search), "vid1")
+        self.assertEqual(resolver.resolve("t1", "Song " * 200, "Artist", search), "vid1")
+        self.assertEqual(search.call_count, 1)
+
+    def test_expired_entries_are_searched_again(self):
+        TrackResolution.objects.create(key=resolver.track_key("t1"), youtube_video_id=None,
+                                       expires=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(resolver.resolve("t1", "Song", "Artist", MagicMock(return_value="vid1")), "vid1")
+
+    def test_concurrent_lookups_share_one_search(self):
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def search():
+            calls.append(1)
+            started.set()
+            release.wait()
+            return "vid1"
+
+        results = []
+        leader = threading.Thread(target=lambda: results.append(resolver.search_once("k", search)))
+        leader.start()
+        started.wait()
+        follower = threading.Thread(target=lambda: results.append(resolver.search_once("k", search)))
+        follower.start()
+        time.sleep(0.2)
+        release.set()
+        leader.join()
+        follower.join()
+        self.assertEqual(results, ["vid1", "vid1"])
+        self.assertEqual(len(calls), 1)
+
+
+def fake_process_image(obj, url, save=True):
+    obj.image.name = f"songs/{obj.id}.jpg"
+    if save:
+        obj.save()
+
+
+@patch('songdownloader.services.spotify.increase_progress')
+@patch('songdownloader.services.spotify.update_progress')
+@patch('songdownloader.services.spotify.process_image', side_effect=fake_process_image)
+@patch('songdownloader.services.spotify.search_song', side_effect=lambda name: None if "missing" in name else f"yt-{name}")
+class SpotifyMakePlaylistTestCase(DatabaseTestCase):
+
+    def make(self, playlist_id, tracks, snapshot_id="snap-1", playlist=None):
+        data = MagicMock()
+        data.name = playlist_id
+        data.image = "https://i.scdn.co/playlist"
+        data.snapshot_id = snapshot_id
+        resolved = []
+        if playlist is None:
+            spotify.make_playlist(playlist_id, data, tracks, "task", lambda counter, song: resolved.append(counter))
+        else:
+            spotify.sync_playlist(playlist, data, tracks, "task", lambda counter, song: resolved.append(counter))
+        return resolved
+
+    def test_sync_only_applies_the_diff(self, mock_search, *mocks):
+        tracks = [spotify.SpotifyTrackItem(track_id, track_id, "A", "https://i.scdn.co/x")
+                  for track_id in ("s1", "s2", "s3")]
+        self.make("p2", tracks[:2])
+        mock_search.reset_mock()
+
+        playlist = SpotifyPlaylist.objects.get(id="p2")
+        resolved = self.make("p2", tracks[1:], snapshot_id="snap-2", playlist=playlist)
+
+        self.assertEqual(sorted(resolved), [1, 2])
+        self.assertEqual([call.args[0] for call in mock_search.call_args_list], ["s3"])
+        playlist.refresh_from_db()
+        self.assertEqual(playlist.snapshot_id, "snap-2")
+        self.assertEqual(sorted(playlist.tracks.values_list("id", flat=True)), ["s2", "s3"])
+
+    def test_playlist_is_built_in_order(self, *mocks):
+        SpotifySong.objects.create(id="s1", name="known", artists="A", youtube_video_id="yt-known",
+                                   image="songs/s1.jpg")
+        tracks = [spotify.SpotifyTrackItem(track_id, name, "A", "https://i.scdn.co/x")
+                  for track_id, name in (("s1", "known"), ("s2", "new"), ("s3", "missing"))]
+        resolved = self.make("p1", tracks)
+
+        self.assertEqual(sorted(resolved), [1, 2])
+        playlist = SpotifyPlaylist.objects.get(id="p1")
+        self.assertEqual(sorted(playlist.tracks.values_list("id", flat=True)), ["s1", "s2"])
+        self.assertEqual(SpotifySong.objects.get(id="s2").youtube_video_id, "yt-new")
+
+    def test_tracks_are_numbered_without_gaps(self, *mocks):
+        tracks = [spotify.SpotifyTrackItem(track_id, name, "A", "https://i.scdn.co/x")
+                  for track_id, name in (("s1", "one"), ("s2", "missing"), ("s3", "three"), ("s1", "one"))]
+        resolved = self.make("p4", tracks)
+
+        self.assertEqual(resolved, [1, 2])
+        playlist = SpotifyPlaylist.objects.get(id="p4")
+        self.assertEqual([(position, song.id) for position, song in playlist.ordered_tracks()],
+                         [(1, "s1"), (2, "s3")])
+
+    def test_sync_keeps_playlist_order(self, *mocks):
+        tracks = [spotify.SpotifyTrackItem(track_id, track_id, "A", "https://i.scdn.co/x")
+                  for track_id in ("s1", "s2", "s3")]
+        self.make("p3", tracks)
+
+        playlist = SpotifyPlaylist.objects.get(id="p3")
+        self.make("p3", [tracks[2], tracks[0]], snapshot_id="snap-2", playlist=playlist)
+
+        self.assertEqual([(position, song.id) for position, song in playlist.ordered_tracks()],
+                         [(1, "s3"), (2, "s1")])
+
+    def test_query_count_does_not_grow_with_playlist(self, *mocks):
+        def count(playlist_id, size):
+            tracks = [spotify.SpotifyTrackItem(f"{playlist_id}-{i}", f"song {i}", "A", "https://i.scdn.co/x")
+                      for i in range(size)]
+            with CaptureQueriesContext(connection) as queries:
+                self.make(playlist_id, tracks)
+            return len(queries)
+
+        self.assertEqual(count("small", 2), count("large", 60))
+
+
+@patch('songdownloader.services.youtube.increase_progress')
+@patch('songdownloader.services.youtube.update_progress')
+@patch('songdownloader.services.youtube.process_image', side_effect=fake_process_image)
+class YoutubeMakePlaylistTestCase(DatabaseTestCase):
+
+    def test_playlist_is_built_from_video_list(self, mock_image, mock_update, mock_progress):
+        videos = [youtube.YoutubeVideo(video_id, video_id, "A", f"https://i.ytimg.com/{video_id}",
+                                       f"https://www.youtube.com/watch?v={video_id}") for video_id in ("v2", "v1")]
+        resolved = []
+        youtube.make_playlist("PL1", "Mix", "https://i.ytimg.com/mix", videos, 3, "task",
+                              lambda counter, song: resolved.append(counter))
+
+        self.assertEqual(sorted(resolved), [1, 2])
+        self.assertEqual(mock_progress.call_count, 1)
+        playlist = YouTubePlaylist.objects.get(id="PL1")
+        self.assertEqual([(position, song.id) for position, song in playlist.ordered_tracks()],
+                         [(1, "v2"), (2, "v1")])
+
+
+class ProgressLedger:
+    """Stands in for the progress functions of ``base.tasks`` and records
+    every value the progress page would be shown."""
+
+    def __init__(self):
+        self.progress = 0
+        self.total = None
+        self.shown = []
+
+    def _show(self):
+        self.shown.append((self.progress, self.total))
+
+    def increase_progress(self, task_id):
+        self.progress += 1
+        self._show()
+
+    def update_progress(self, name, task_id, img=None):
+        self.increase_progress(task_id)
+
+    def set_progress(self, progress, task_id):
+        self.progress = progress
+        self._show()
+
+    def set_progress_fields(self, task_id, **fields):
+        self.progress = int(fields.get("progress", self.progress))
+        self.total = int(fields.get("total", self.total or 0))
+        self._show()
+
+    def patchers(self, module, *names):
+        return [patch(f"{module}.{name}", getattr(self, name)) for name in names]
+
+    def assert_never_past_total(self, test):
+        test.assertTrue(self.shown)
+        for progress, total in self.shown:
+            if total:
+                test.assertLessEqual(progress, total)
+        test.assertEqual(self.shown[-1][0], self.total)
+
+
+class FakeSession:
+    # Counts one step per queued track, like DownloadSession does when the
+    # track is downloaded.
+    def __init__(self, zip_name, folder, task_id, archive=True):
+        self.task_id = task_id
+        self.queued = 0
+        self.tasks = []
+
+    def start(self):
+        return self
+
+    def put(self, task):
+        self.queued += 1
+        self.tasks.append(task)
+        tasks.increase_progress(self.task_id)
+
+    def finish(self):
+        return [task["name"] for task in self.tasks], [], "archive.zip", "folder"
+
+
+@patch('songdownloader.tasks.delete_task_data')
+@patch('songdownloader.tasks.delete_folder')
+@patch('songdownloader.tasks.UserLogRecent')
+@patch('songdownloader.tasks.User')
+@patch('songdownloader.tasks.DownloadSession', FakeSession)
+class JobProgressTestCase(DatabaseTestCase):
+
+    def setUp(self):
+        self.ledger = ProgressLedger()
+        patchers = (self.ledger.patchers('songdownloader.tasks', 'increase_progress', 'set_progress',
+                                         'set_progress_fields')
+                    + self.ledger.patchers('songdownloader.services.youtube', 'increase_progress', 'update_progress')
+                    + self.ledger.patchers('songdownloader.services.spotify', 'increase_progress', 'update_progress'))
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def run_task(self, task, url):
+        with patch.object(task, 'update_state'):
+            return task.apply(args=("user", url), task_id="job").get()
+
+    @patch('songdownloader.services.youtube.process_image', side_effect=fake_process_image)
+    @patch('songdownloader.services.quota.redis_db')
+    @patch('songdownloader.services.youtube.get_client')
+    @patch('songdownloader.services.youtube.SongLyrics')
+    def test_youtube_playlist_stays_within_total(self, mock_lyrics, mock_client, mock_redis, *mocks):
+        mock_redis.get.return_value = None
+        client = mock_client.return_value
+        client.playlists.return_value.list.return_value.execute.return_value = {"items": [{
+            "snippet": {"title": "Mix", "thumbnails": {"high": {"url": "https://i.ytimg.com/mix"}}},
+            "contentDetails": {"itemCount": 4},
+        }]}
+        page = youtube_page(["v1", "v2", "v3"])
+        page["items"].append({"snippet": {"title": "Private video", "thumbnails": {}},
+                              "contentDetails": {"videoId": "v4"}})
+        client.playlistItems.return_value.list.return_value.execute.return_value = page
+        client.videos.return_value.list.side_effect = lambda **kwargs: MagicMock(execute=lambda: {"items": [
+            {"id": video_id, "snippet": {"description": "", "tags": []}} for video_id in kwargs["id"].split(",")]})
+
+        result = self.run_task(tasks.youtube_playlist, "https://www.youtube.com/playlist?list=PL1")
+
+        self.assertEqual(result["success"], 3)
+        self.ledger.assert_never_past_total(self)
+
+    @patch('songdownloader.services.spotify.process_image', side_effect=fake_process_image)
+    @patch('songdownloader.services.spotify.search_song', side_effect=lambda name: f"yt-{name}")
+    @patch('songdownloader.tasks.Spotify')
+    def test_spotify_playlist_stays_within_total(self, mock_spotify, *mocks):
+        data = mock_spotify.return_value.data
+        mock_spotify.return_value.id = "p1"
+        data.name = "Mix"
+        data.snapshot_id = "snap-1"
+        data.track_list = [spotify.SpotifyTrackItem(track_id, track_id, "A", "https://i.scdn.co/x")
+                           for track_id in ("s1", "s2", "s3")]
+
+        result = self.run_task(tasks.spotify_playlist, "https://open.spotify.com/playlist/p1")
+
+        self.assertEqual(result["success"], 3)
+        self.ledger.assert_never_past_total(self)
+
+
+def jpeg_bytes(size):
+    buffer = io.BytesIO()
+    Image.new("RGB", size, "red").save(buffer, "JPEG")
+    return buffer.getvalue()
+
+
+@patch('songdownloader.services.images.http')
+class ImagePipelineTestCase(DatabaseTestCase):
+
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        media = override_settings(MEDIA_ROOT=media_root)
+        media.enable()
+        self.addCleanup(media.disable)
+        redis_patch = patch('songdownloader.services.images.redis_db')
+        self.redis = redis_patch.start()
+        self.redis.exists.return_value = 0
+        self.addCleanup(redis_patch.stop)
+
+    def test_shared_cover_is_fetched_once_and_resized(self, mock_http):
+        mock_http.get.return_value = MagicMock(content=jpeg_bytes((640, 480)))
+        first = SpotifySong(id="s1", name="one", artists="A")
+        second = SpotifySong(id="s2", name="two", artists="A")
+        images.process_image(first, "https://i.scdn.co/album")
+        images.process_image(second, "https://i.scdn.co/album")
+
+        mock_http.get.assert_called_once()
+        self.assertEqual(first.image.name, second.image.name)
+        self.assertTrue(first.image.name.endswith("-300.webp"))
+        with Image.open(default_storage.open(first.image.name)) as rendition:
+            self.assertEqual(rendition.size, (300, 225))
+        original = images.image_names("songs", "https://i.scdn.co/album")[0]
+        self.assertTrue(default_storage.exists(original))
+
+        first.delete()
+        self.assertTrue(images.release_image(first.image.name))
+        self.assertTrue(default_storage.exists(second.image.name))
+        second.delete()
+        self.assertTrue(images.release_image(second.image.name))
+        self.assertFalse(default_storage.exists(second.image.name))
+        self.assertFalse(default_storage.exists(original))
+
+    def test_recently_handed_out_image_is_kept(self, mock_http):
+        mock_http.get.return_value = MagicMock(content=jpeg_bytes((64, 64)))
+        song = SpotifySong(id="s1", name="one", artists="A")
+        images.process_image(song, "https://i.scdn.co/album", save=False)
+        self.redis.set.assert_called_with(f"image-in-use-{song.image.name}", 1, ex=images.IN_USE_TTL)
+
+        self.redis.exists.return_value = 1
+        self.assertFalse(images.release_image(song.image.name))
+        self.assertTrue(default_storage.exists(song.image.name))
+
+    def test_original_keeps_its_format(self, mock_http):
+        buffer = io.BytesIO()
+        Image.new("RGB", (64, 64), "red").save(buffer, "PNG")
+        mock_http.get.return_value = MagicMock(content=buffer.getvalue())
+        song = SpotifySong(id="s1", name="one", artists="A")
+        images.process_image(song, "https://i.scdn.co/album")
+
+        original = images.image_names("songs", "https://i.scdn.co/album", "png")[0]
+        self.assertTrue(default_storage.exists(original))
+        song.delete()
+        images.release_image(song.image.name)
+        self.assertFalse(default_storage.exists(original))
@@ -1,8 +1,5 @@
-import json
-import time
 from pathlib import Path
 
-import redis
 from celery.result import AsyncResult
 from django.contrib import messages
 from django.core.exceptions import PermissionDenied
@@ -10,14 +7,11 @@ from django.http import FileResponse, Http404
 from django.shortcuts import render, redirect
 from django.urls import reverse
 
-from PaulStudios import settings
-from base.tasks import set_progress, update_celery_task_list
+from base.tasks import is_registered_task, register_task, set_progress_fields
 from profiles.views import user_check
 from .forms import DataForm
 from .tasks import spotify_playlist, spotify_track, youtube_playlist, youtube_track
 
-redis_db = redis.from_url(settings.REDIS_URL, decode_responses=True)
-
 
 def index(request):
     check = user_check(request)
@@ -38,10 +32,8 @@ def index(request):
             elif service == "Youtube" and mode == "Track":
                 t = youtube_track.delay(request.user.id, url)
             print(t)
-            update_celery_task_list.delay()
-            set_progress(0, t)
-            redis_db.set(f"total-{t}", 1000)
-            redis_db.set(f"image-{t}", "/static/logo.png")
+            register_task(t)
+            set_progress_fields(t, progress=0, total=1000, image="/static/logo.png")
             return redirect(reverse("songdownloader:progress", kwargs={"task_id": t}))
         else:
             for key, error in list(form.errors.items()):
@@ -55,17 +47,10 @@ def index(request):
 
 
 def show_progress(request, task_id):
-    update_celery_task_list.delay()
-    task_list = json.loads(redis_db.get("task_list"))
-    if task_id not in task_list:
-        retries = int(redis_db.get(f"progress-retry-{request.user.id}-{task_id}") or 0)
-        if retries > 3:
-            redis_db.delete(f"progress-retry-{request.user.id}-{task_id}")
-            raise Http404
-        else:
-            time.sleep(0.6)
-            redis_db.set(f"progress-retry-{request.user.id}-{task_id}", retries + 1)
-            return redirect(reverse("songdownloader:progress", kwargs={"task_id": task_id}))
+    # Tasks are registered before the redirect here, so there is nothing
+    # to wait for.
+    if not is_registered_task(task_id):
+        raise Http404
     return render(request, 'songdownloader/progress.html', {'task_id': task_id})
 
 